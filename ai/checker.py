@@ -1,10 +1,19 @@
 import pickle
+
+import tensorflow as tf
 from keras.preprocessing.sequence import pad_sequences
 from keras.models import model_from_json
 from ai.model import Model
 
 
 class Checker(Model):
+    """
+    Keras model, safe to call from worker threads other than the one
+    that loaded it.
+    """
+
+    graph = None
+
     def load(self, architecture, weights, tokenizer, maxlen):
         self.maxlen = maxlen
 
@@ -14,6 +23,7 @@ class Checker(Model):
         with open(architecture, 'r') as f:
             self.model = model_from_json(f.read())
         self.model.load_weights(weights)
+        self._prepare()
 
     def load_from_package(self, maxlen):
         self.maxlen = maxlen
@@ -29,10 +39,32 @@ class Checker(Model):
         with open(architecture, 'r') as f:
             self.model = model_from_json(f.read())
         self.model.load_weights(weights)
+        self._prepare()
+
+    def _prepare(self):
+        # On the TF1 backend, the predict function is built lazily in the
+        # default graph of the calling thread, which is not the one the
+        # model lives in. Build it now and predict in the loading graph.
+        if hasattr(self.model, '_make_predict_function'):
+            self.model._make_predict_function()
+            self.graph = tf.get_default_graph()
+
+    def _predict(self, x_s):
+        if self.graph is None:
+            return self.model.predict([x_s])
+        with self.graph.as_default():
+            return self.model.predict([x_s])
 
     def process(self, msg):
         tokenized_msg = self.tokenizer.texts_to_sequences([msg])
         x_s = pad_sequences(tokenized_msg, self.maxlen)
-        predictions = self.model.predict([x_s])
+        predictions = self._predict(x_s)
 
         return predictions.squeeze().tolist()
+
+    def process_batch(self, msgs):
+        tokenized_msgs = self.tokenizer.texts_to_sequences(msgs)
+        x_s = pad_sequences(tokenized_msgs, self.maxlen)
+        predictions = self._predict(x_s)
+
+        return predictions.tolist()
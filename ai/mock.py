@@ -10,3 +10,7 @@ class MockChecker(Model):
     def process(self, msg):
         time.sleep(1.2 * random.random())
         return [int(kw in msg) for kw in self.keywords]
+
+    def process_batch(self, msgs):
+        time.sleep(1.2 * random.random())
+        return [[int(kw in msg) for kw in self.keywords] for msg in msgs]
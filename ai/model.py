@@ -11,3 +11,12 @@ class Model(ABC):
         :return: a list of numbers from [0,1]
         """
         raise NotImplementedError("Subclasses must implement this method!")
+
+    def process_batch(self, msgs):
+        """
+        Processes many messages at once. Override it when the model can
+        do better than one `process` call per message.
+        :param msgs: list of one line strings
+        :return: list of results of `process`, in the same order
+        """
+        return [self.process(msg) for msg in msgs]
@@ -1,16 +1,21 @@
 import typing
 import json
+from collections import deque
 from twisted.application import service
 from twisted.internet.protocol import ServerFactory
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
-from twisted.web.client import Agent
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+from twisted.internet import defer
 from twisted.internet.defer import succeed
+from twisted.internet.task import LoopingCall
 from twisted.web.iweb import IBodyProducer
 from zope.interface import implementer
 
 from chat import communication as comm
 from chat import config
+from chat import util
 import ai
 
 
@@ -46,39 +51,217 @@ class StringProducer(object):
         pass
 
 
+class ExportError(Exception):
+    """Monitor did not accept exported records."""
+    pass
+
+
+class MonitorExporter:
+    """
+    Buffers scored messages and posts them to the monitor as a single
+    JSON array every `flush_interval` seconds or `flush_size` records,
+    over persistent pooled HTTP connections.
+
+    Records of a failed post go back to the buffer and are retried with
+    the next flush, a post taking over `post_timeout` seconds fails. The
+    buffer holds at most `max_spill` records, the oldest ones are dropped
+    beyond that. On stop, the buffer is posted for up to `stop_timeout`
+    seconds, a post still in flight then is cancelled.
+    """
+
+    def __init__(self, url, flush_size, flush_interval, max_spill, post_timeout, stop_timeout,
+                 clock=None):
+        from twisted.internet import reactor
+        self.clock = clock or reactor
+        self.url = url.encode(errors='ignore')
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_spill = max_spill
+        self.post_timeout = post_timeout
+        self.stop_timeout = stop_timeout
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.agent = Agent(reactor, pool=self.pool)
+        self._loop = LoopingCall(self.flush)
+        self._loop.clock = self.clock
+
+        self._buffer = deque()
+        self._post = None
+        self.sent = 0
+        self.dropped = 0
+
+    def start(self):
+        self._loop.start(self.flush_interval, now=False)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+        deadline = self.clock.callLater(self.stop_timeout, self._cancel_post)
+        try:
+            while deadline.active():
+                if self._post is not None:
+                    yield self._post
+                elif self._buffer:
+                    sent = self.sent
+                    yield self.flush()
+                    if self.sent == sent:
+                        # Failed, the monitor is unlikely to recover in time.
+                        break
+                else:
+                    break
+        finally:
+            if deadline.active():
+                deadline.cancel()
+
+        if self._buffer:
+            log.err(f'Dropped {len(self._buffer)} scored messages on stop')
+        yield self.pool.closeCachedConnections()
+
+    def _cancel_post(self):
+        if self._post is not None:
+            self._post.cancel()
+
+    def export(self, record):
+        self._buffer.append(record)
+        self._trim()
+
+        if len(self._buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self._post is not None or not self._buffer:
+            return succeed(None)
+
+        count = min(self.flush_size, len(self._buffer))
+        batch = [self._buffer.popleft() for _ in range(count)]
+        body = json.dumps(batch, ensure_ascii=False).encode(errors='ignore')
+
+        d = self._post = self.agent.request(b'POST', self.url,
+                                            Headers({'Content-Type': ['application/json']}),
+                                            StringProducer(body))
+        d.addCallback(self._on_response)
+        d.addTimeout(self.post_timeout, self.clock)
+        d.addCallbacks(self._on_sent, self._on_failure,
+                       callbackArgs=(batch,), errbackArgs=(batch,))
+        return d
+
+    @staticmethod
+    def _on_response(response):
+        def check(_):
+            if not 200 <= response.code < 300:
+                raise ExportError(f'monitor responded with {response.code}')
+
+        # Body has to be consumed for the connection to go back to the pool.
+        return readBody(response).addCallback(check)
+
+    def _on_sent(self, _, batch):
+        self._post = None
+        self.sent += len(batch)
+        log.msg(f'Sent {len(batch)} scored messages to monitor!')
+
+        if len(self._buffer) >= self.flush_size:
+            self.flush()
+
+    def _on_failure(self, reason, batch):
+        self._post = None
+        log.err(f'Failed to send to monitor: {reason.getErrorMessage()}')
+
+        self._buffer.extendleft(reversed(batch))
+        self._trim()
+
+    def _trim(self):
+        while len(self._buffer) > self.max_spill:
+            self._buffer.popleft()
+            self.dropped += 1
+
+
+class MicroBatcher:
+    """
+    Collects submitted items for up to `max_delay` seconds or `max_size`
+    items, whichever comes first, and processes them with a single
+    `process_batch` call. Each submitter gets its own Deferred that fires
+    with its row of the batch result.
+    """
+
+    def __init__(self, process_batch, max_size, max_delay, clock=None):
+        from twisted.internet import reactor
+        self.clock = clock or reactor
+        self.process_batch = process_batch
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self._items = []
+        self._deferreds = []
+        self._delayed_flush = None
+        self._in_flight = set()
+
+    def submit(self, item):
+        d = defer.Deferred()
+        self._items.append(item)
+        self._deferreds.append(d)
+
+        if len(self._items) >= self.max_size:
+            self.flush()
+        elif self._delayed_flush is None:
+            self._delayed_flush = self.clock.callLater(self.max_delay, self.flush)
+
+        return d
+
+    def flush(self):
+        """
+        Processes the collected items. Returns a Deferred firing once all
+        batches started so far are done.
+        """
+        if self._delayed_flush is not None and self._delayed_flush.active():
+            self._delayed_flush.cancel()
+        self._delayed_flush = None
+
+        items, deferreds = self._items, self._deferreds
+        self._items, self._deferreds = [], []
+        if items:
+            self._process(items, deferreds)
+
+        return defer.DeferredList(list(self._in_flight))
+
+    def _process(self, items, deferreds):
+        def fan_out(results):
+            for d, result in zip(deferreds, results):
+                d.callback(result)
+
+        def fail_all(reason):
+            log.err(f'Batch of {len(items)} failed: {reason.getErrorMessage()}')
+            for d in deferreds:
+                d.errback(reason)
+
+        d = defer.maybeDeferred(self.process_batch, items)
+        d.addCallbacks(fan_out, fail_all)
+        if not d.called:
+            self._in_flight.add(d)
+            d.addBoth(lambda _: self._in_flight.discard(d))
+
+
 class ToxicFactory(ServerFactory):
     protocol = ToxicServiceProtocol
 
     def __init__(self, service):
         self.service = service
 
-        from twisted.internet import reactor
-        self.agent = Agent(reactor)
-
     def on_msg(self, msg):
+        d = self.service.process(msg.params[1])
+        d.addCallback(self.on_scores, msg)
+        d.addErrback(lambda f: log.err(f'Failed to score message: {f.getErrorMessage()}'))
+
+    def on_scores(self, scores, msg):
         content = msg.params[1]
-        scores = self.service.process(content)
         log.msg(f'Got scores: {scores}')
 
-        body_dict = {'author': msg.prefix,
-                     'channel': msg.params[0],
-                     'content': content,
-                     'scores': scores}
-        body_json = json.dumps(body_dict, ensure_ascii=False).encode(errors='ignore')
-
-        body = StringProducer(body_json)
-        d = self.agent.request('POST'.encode(),
-                               config.flask_host.encode(errors='ignore'),
-                               bodyProducer=body)
-
-        def on_response(_):
-            log.msg('Sent to monitor!')
-
-        def on_failure(reason):
-            print(reason)
-            log.err('Failed to send to monitor: ' + reason.getErrorMessage())
-
-        d.addCallbacks(on_response, on_failure)
+        record = {'author': msg.prefix,
+                  'channel': msg.params[0],
+                  'content': content,
+                  'scores': scores}
+        self.service.exporter.export(record)
 
 
 class ToxicService(service.Service):
@@ -86,16 +269,46 @@ class ToxicService(service.Service):
         self.model_path = model_path
         self.get_model = get_model
         self.model = None
+        self.batcher = MicroBatcher(self._process_batch,
+                                    config.ai_batch_size,
+                                    config.ai_batch_delay)
+        self.pool = util.WorkerPool(config.ai_workers,
+                                    config.ai_max_queued,
+                                    config.ai_overload_policy,
+                                    name='inference')
+        self.exporter = MonitorExporter(config.flask_ingest_url,
+                                        config.monitor_flush_size,
+                                        config.monitor_flush_interval,
+                                        config.monitor_max_spill,
+                                        config.monitor_post_timeout,
+                                        config.monitor_stop_timeout)
 
     def startService(self):
         self.model = self.get_model(self.model_path)
         log.msg(f'Loaded model from {self.model_path}')
+        self.pool.start()
+        self.exporter.start()
 
         self.factory = ToxicFactory(self)
         from twisted.internet import reactor
-        reactor.listenTCP(config.ai_server_port,
-                          self.factory,
-                          interface=config.ai_server_host)
+        self.port = reactor.listenTCP(config.ai_server_port,
+                                      self.factory,
+                                      interface=config.ai_server_host)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        # Scores of the last batches are exported before the exporter stops.
+        yield self.port.stopListening()
+        yield self.batcher.flush()
+        self.pool.stop()
+        yield self.exporter.stop()
 
     def process(self, msg):
-        return self.model.process(msg)
+        return self.batcher.submit(msg)
+
+    def _process_batch(self, msgs):
+        return self.pool.submit(self._predict, msgs)
+
+    def _predict(self, msgs):
+        # Runs in a worker thread.
+        return self.model.process_batch(msgs)
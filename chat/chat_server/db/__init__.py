@@ -1 +1 @@
-from .db import DBService
\ No newline at end of file
+from .db import DBService, DBError, DBTimeout
\ No newline at end of file
@@ -0,0 +1,136 @@
+import sqlite3
+from itertools import groupby
+from operator import itemgetter
+
+from twisted.internet import defer, task
+from twisted.python import failure, log
+
+
+class WriteBehind:
+    """
+    Queues writes for up to `max_delay` seconds or `max_size` writes,
+    whichever comes first, and commits them in a single transaction.
+    Consecutive writes of the same statement go in one `executemany`.
+
+    Each writer gets its own Deferred that fires once its write is
+    committed, right after its `on_commit` callable is called. Unlike
+    the Deferred's callbacks, `on_commit` is called even if the Deferred
+    was cancelled in the meantime. Committed is not durable: with
+    synchronous=NORMAL in WAL mode, the last commits may be lost on a
+    power failure, though not on a crash of the process.
+
+    A batch that finds the database locked is retried up to
+    `lock_retries` times, `max_delay` seconds apart, then fails. If a
+    batch fails otherwise, its writes are retried one at a time, so that
+    only the failing ones fail.
+    """
+
+    def __init__(self, pool, max_size, max_delay, lock_retries=3, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.pool = pool
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.lock_retries = lock_retries
+        self.clock = clock
+
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+
+        self._queue = []
+        self._delayed_flush = None
+        self._flushing = False
+        self._waiters = []
+
+    def write(self, statement, params, on_commit=None):
+        d = defer.Deferred()
+        self._queue.append((statement, params, d, on_commit))
+
+        if self._flushing:
+            # Picked up by the running flush.
+            pass
+        elif len(self._queue) >= self.max_size:
+            self.flush()
+        elif self._delayed_flush is None:
+            self._delayed_flush = self.clock.callLater(self.max_delay, self.flush)
+
+        return d
+
+    def flush(self):
+        """
+        Commits all queued writes. Returns a Deferred firing once they
+        are committed, or failed.
+        """
+        if self._delayed_flush is not None and self._delayed_flush.active():
+            self._delayed_flush.cancel()
+        self._delayed_flush = None
+
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if not self._flushing:
+            self._run()
+        return d
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'batches': self.batches,
+            'writes': self.writes,
+            'failed': self.failed,
+        }
+
+    @defer.inlineCallbacks
+    def _run(self):
+        self._flushing = True
+        try:
+            while self._queue:
+                batch = self._queue[:self.max_size]
+                del self._queue[:self.max_size]
+                yield self._commit(batch)
+        finally:
+            self._flushing = False
+            waiters, self._waiters = self._waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    @defer.inlineCallbacks
+    def _commit(self, batch, attempt=0):
+        try:
+            yield self.pool.runInteraction(self._execute, [entry[:2] for entry in batch])
+        except Exception:
+            reason = failure.Failure()
+            if self._locked(reason) and attempt < self.lock_retries:
+                log.msg(f'DB: batch of {len(batch)} writes found the database locked, retrying')
+                yield task.deferLater(self.clock, self.max_delay, lambda: None)
+                yield self._commit(batch, attempt + 1)
+            elif len(batch) == 1 or self._locked(reason):
+                self.failed += len(batch)
+                log.err(f'DB: {len(batch)} writes failed: {reason.getErrorMessage()}')
+                for entry in batch:
+                    if not entry[2].called:
+                        entry[2].errback(reason)
+            else:
+                log.msg(f'DB: batch of {len(batch)} writes failed, retrying one by one')
+                for entry in batch:
+                    yield self._commit([entry])
+            return
+
+        self.batches += 1
+        self.writes += len(batch)
+        for _, _, d, on_commit in batch:
+            if on_commit is not None:
+                on_commit()
+            if not d.called:
+                d.callback(None)
+
+    @staticmethod
+    def _locked(reason):
+        return (reason.check(sqlite3.OperationalError) is not None
+                and any(word in reason.getErrorMessage() for word in ('locked', 'busy')))
+
+    @staticmethod
+    def _execute(transaction, writes):
+        for statement, group in groupby(writes, key=itemgetter(0)):
+            transaction.executemany(statement, [params for _, params in group])
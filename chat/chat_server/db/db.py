@@ -1,188 +1,543 @@
 import sqlite3
-from functools import wraps
-from twisted.python import log, failure
+import threading
+import time
+from collections import Counter
+from functools import partial, wraps
+from twisted.python import log
 from twisted.internet import defer
 from twisted.application import service
 from twisted.enterprise import adbapi
 from chat import config
+from chat import util
 from chat.chat_server.db import query
+from chat.chat_server.db.batch import WriteBehind
+from chat.chat_server.db.directory import Directory
+from chat.chat_server.db.password import PasswordHasher
+from chat.chat_server.instrument import Instrumentation
 
 
-def log_operation(method):
-    @defer.inlineCallbacks
+class DBError(Exception):
+    """A DBService operation failed."""
+
+
+class DBTimeout(DBError):
+    """A DBService operation missed its deadline and was cancelled."""
+
+
+def operation(method):
+    """
+    Makes a DBService method an operation: it gets a deadline, its
+    latency is observed and its failures are logged and turned into
+    DBError.
+    """
+    name = method.__name__
+
     @wraps(method)
-    def wrapper(*args, **kwargs):
-        try:
-            res = yield method(*args, **kwargs)
-            log.msg(f'DB: {method.__name__} CALL SUCCESSFUL')
-            return res
-        except failure.Failure as f:
-            log.err(f'DB: {method.__name__} CALL FAILURE: {f.getErrorMessage()}')
-            raise f
+    def wrapper(self, *args, **kwargs):
+        return self._operation(name, method, self, *args, **kwargs)
 
     return wrapper
 
 
-# TODO: add timeouts on DB operations!
+def first_error(reason):
+    """Unwraps the failure of a gatherResults Deferred."""
+    reason.trap(defer.FirstError)
+    return reason.value.subFailure
+
+
 class DBService(service.Service):
+    """
+    Queries run on a pool of reader connections, while all writes go
+    through a single writer connection, so that in WAL mode readers are
+    never blocked by writers and writers never contend for the lock.
+    Notifications and membership changes are queued and committed in
+    batches. Other writes wait for the queue to be committed first, so
+    that all writes commit in the order they were issued.
+
+    Users, channels and memberships are looked up in a Directory loaded
+    at startup. This service is the only writer, so applying its own
+    writes to the directory as they commit keeps it up to date.
+
+    Each operation is cancelled if it takes longer than its deadline,
+    which interrupts the SQLite statement it is waiting for. Interrupting
+    does not end a wait for a lock, so lock waits are limited to half
+    the shortest deadline instead.
+
+    Passwords are stored hashed, hashing runs on a PasswordHasher.
+    Passwords stored in plaintext or at a lower cost than configured are
+    rehashed when their users log in.
+    """
+
     def __init__(self):
-        self._dbpool = None
+        self._read_pool = None
+        self._write_pool = None
+        self._writes = None
+        self.passwords = PasswordHasher(config.password_cost,
+                                        config.password_workers,
+                                        config.password_max_queued,
+                                        {'ip': config.password_max_per_ip,
+                                         'nick': config.password_max_per_nick})
+        self.directory = Directory()
+        self.instrumentation = Instrumentation('DB')
+        self.timeouts = Counter()
 
     def startService(self):
-        self._dbpool = adbapi.ConnectionPool(config.db_type,
-                                             config.db_name,
-                                             check_same_thread=False,
-                                             cp_openfun=self._enable_fk)
-        self._init_db()
+        # Blocks the startup, as nothing can be looked up before it is done.
+        con = sqlite3.connect(config.db_name)
+        try:
+            self._create_tables(con.cursor())
+            con.commit()
+            self.directory.load(con.cursor())
+        finally:
+            con.close()
+        log.msg(f'DB: loaded {self.directory.stats()}')
+
+        self._write_pool = adbapi.ConnectionPool(config.db_type,
+                                                 config.db_name,
+                                                 check_same_thread=False,
+                                                 cp_min=1,
+                                                 cp_max=1,
+                                                 cp_openfun=self._open_writer)
+        self._read_pool = adbapi.ConnectionPool(config.db_type,
+                                                config.db_name,
+                                                check_same_thread=False,
+                                                cp_min=1,
+                                                cp_max=config.db_readers,
+                                                cp_openfun=self._open_reader)
+        self._writes = WriteBehind(self._write_pool,
+                                   config.db_write_batch_size,
+                                   config.db_write_batch_delay,
+                                   config.db_write_lock_retries)
+        self.passwords.start()
 
+    @defer.inlineCallbacks
     def stopService(self):
-        self._dbpool.close()
+        self.passwords.stop()
+        yield self._writes.flush()
+        self._read_pool.close()
+        self._write_pool.close()
+
+    def stats(self):
+        return {
+            'directory': self.directory.stats(),
+            'writes': self._writes.stats(),
+            'passwords': self.passwords.stats(),
+            'timeouts': dict(self.timeouts),
+        }
+
+    def _operation(self, name, method, *args, **kwargs):
+        from twisted.internet import reactor
+
+        start = time.perf_counter()
+        d = defer.maybeDeferred(method, *args, **kwargs)
+        d.addTimeout(config.db_timeouts.get(name, config.db_timeout), reactor)
+
+        def succeeded(result):
+            self.instrumentation.observe(name, time.perf_counter() - start)
+            log.msg(f'DB: {name} CALL SUCCESSFUL')
+            return result
+
+        def failed(reason):
+            self.instrumentation.observe(name, time.perf_counter() - start)
+            if reason.check(DBError):
+                # Failure of a nested operation, already reported.
+                return reason
+            if reason.check(util.Overloaded):
+                log.msg(f'DB: {name} REJECTED: {reason.getErrorMessage()}')
+                return reason
+            if reason.check(defer.TimeoutError):
+                self.timeouts[name] += 1
+                log.err(f'DB: {name} TIMED OUT')
+                raise DBTimeout(name)
+            log.err(f'DB: {name} CALL FAILURE: {reason.getErrorMessage()}')
+            raise DBError(reason.getErrorMessage())
+
+        d.addCallbacks(succeeded, failed)
+        return d
 
-    def _init_db(self):
-        self._dbpool.runInteraction(self._create_tables)
+    @staticmethod
+    def _run(pool, interaction, *args, on_commit=None):
+        """
+        Runs `interaction` in a transaction on `pool`. Cancelling the
+        returned Deferred interrupts the statement being executed, or
+        skips the interaction if it has not started yet. Once it has
+        returned, its connection is left alone, as it may already be
+        running the next interaction.
+
+        `on_commit` is called with the result of a committed interaction,
+        even if the returned Deferred was cancelled in the meantime.
+        """
+        lock = threading.Lock()
+        running = []
+        cancelled = []
+
+        def run(transaction):
+            with lock:
+                if cancelled:
+                    raise defer.CancelledError()
+                running.append(pool.connect())
+            try:
+                return interaction(transaction, *args)
+            finally:
+                with lock:
+                    running.clear()
+
+        def cancel(_):
+            with lock:
+                cancelled.append(True)
+                for con in running:
+                    con.interrupt()
+
+        def finished(result):
+            if on_commit is not None:
+                on_commit(result)
+            if not d.called:
+                d.callback(result)
+
+        def failed(reason):
+            if not d.called:
+                d.errback(reason)
+
+        d = defer.Deferred(cancel)
+        pool.runInteraction(run).addCallbacks(finished, failed)
+        return d
+
+    def _query(self, statement, params=()):
+        return self._run(self._read_pool, self._fetch_all, statement, params)
+
+    def _transaction(self, interaction, *args, on_commit=None):
+        """
+        Runs `interaction` on the writer once the queued writes are
+        committed, so that writes commit in the order they were issued.
+        """
+        d = self._writes.flush()
+        d.addCallback(lambda _: self._run(self._write_pool, interaction, *args, on_commit=on_commit))
+        return d
+
+    def _write(self, statement, params=(), on_commit=None):
+        return self._transaction(self._execute, statement, params, on_commit=on_commit)
 
     @staticmethod
-    def _enable_fk(con):
-        con.execute('PRAGMA foreign_keys = ON;')
+    def _fetch_all(transaction, statement, params):
+        transaction.execute(statement, params)
+        return transaction.fetchall()
+
+    @staticmethod
+    def _execute(transaction, statement, params):
+        transaction.execute(statement, params)
+
+    @staticmethod
+    def _busy_timeout():
+        # In milliseconds. An interrupt does not end a wait for a lock,
+        # so a stalled operation holds its pool thread for this long.
+        deadline = min([config.db_timeout, *config.db_timeouts.values()])
+        return int(deadline * 1000 / 2)
+
+    @classmethod
+    def _configure(cls, con):
+        con.execute('PRAGMA foreign_keys = ON')
+        con.execute(f'PRAGMA busy_timeout = {cls._busy_timeout()}')
+        con.execute(f'PRAGMA cache_size = {int(config.db_page_cache_size)}')
+        con.execute(f'PRAGMA mmap_size = {int(config.db_mmap_size)}')
+
+    @classmethod
+    def _open_writer(cls, con):
+        # Journal mode is persistent, so setting it once here is enough.
+        con.execute(f'PRAGMA journal_mode = {config.db_journal_mode}')
+        con.execute(f'PRAGMA synchronous = {config.db_synchronous}')
+        cls._configure(con)
+
+    @classmethod
+    def _open_reader(cls, con):
+        cls._configure(con)
+        con.execute('PRAGMA query_only = ON')
 
     @staticmethod
     def _create_tables(transaction):
-        transaction.execute(query.create_table_user)
-        transaction.execute(query.create_table_channel)
-        transaction.execute(query.create_table_is_member)
-        transaction.execute(query.create_table_notification)
+        # Schema version is kept in user_version, databases created
+        # before it was introduced are at version 0.
+        transaction.execute('BEGIN IMMEDIATE')
+        transaction.execute('PRAGMA user_version')
+        version = transaction.fetchone()[0]
+
+        for statements in query.migrations[version:]:
+            for statement in statements:
+                transaction.execute(statement)
 
+        if version < len(query.migrations):
+            log.msg(f'DB: schema migrated from version {version} to {len(query.migrations)}')
+            transaction.execute(f'PRAGMA user_version = {len(query.migrations)}')
+
+    @operation
     @defer.inlineCallbacks
     def account_available(self, nick, mail):
-        try:
-            nicks = yield self._dbpool.runQuery(query.select_nick, (nick,))
-            mails = yield self._dbpool.runQuery(query.select_mail, (mail,))
-            log.msg('DB: account_available CALL SUCCESSFUL')
-            return nicks == [], mails == []
-        except failure.Failure as f:
-            log.err(f'DB: account_available CALL FAILURE: {f.getErrorMessage()}')
-            raise
-
-    @log_operation
-    @defer.inlineCallbacks
-    def users_registered(self, nicks):
-        select = query.select_nicks(len(nicks))
-        result = yield self._dbpool.runQuery(select, nicks)
-        return [r[0] for r in result]
+        nicks, mails = yield defer.gatherResults([
+            self._query(query.select_nick, (nick,)),
+            self._query(query.select_mail, (mail,)),
+        ], consumeErrors=True).addErrback(first_error)
+        return nicks == [], mails == []
 
-    @log_operation
-    def add_user(self, nick, mail, password):
-        return self._dbpool.runOperation(query.insert_user, (nick, mail, password))
+    def users_registered(self, nicks):
+        return defer.succeed(self.directory.registered(nicks))
 
-    @log_operation
+    @operation
+    @defer.inlineCallbacks
+    def add_user(self, nick, mail, password, keys=None):
+        """
+        Registers a user with a hash of `password`. Hashing is charged to
+        `keys`, see PasswordHasher, and fails with Overloaded over its limits.
+        """
+        hashed = yield self.passwords.hash(password, keys or {})
+        yield self._write(query.insert_user, (nick, mail, hashed),
+                          on_commit=lambda _: self.directory.add_user(nick))
+
+    @operation
     def delete_user(self, nick):
-        return self._dbpool.runOperation(query.delete_user, (nick,))
+        return self._write(query.delete_user, (nick,),
+                           on_commit=lambda _: self.directory.delete_user(nick))
 
+    @operation
     @defer.inlineCallbacks
-    def password_correct(self, nick, password):
-        try:
-            correct_password = yield self._dbpool.runQuery(query.select_password, (nick,))
-            log.err('DB: password_correct CALL SUCCESSFUL')
-            if correct_password:
-                return correct_password[0][0] == password
-            else:
-                log.err('DB: password_correct CALL FAILURE: no such user in database')
-                raise failure.Failure(sqlite3.IntegrityError())
-        except failure.Failure as f:
-            log.err(f'DB: password_correct FAILURE: {f.getErrorMessage()}')
-            raise
-
-    @log_operation
-    @defer.inlineCallbacks
-    def channel_exists(self, channel_name):
-        channels = yield self._dbpool.runQuery(query.select_channel, (channel_name,))
-        return len(channels) != 0
+    def password_correct(self, nick, password, keys=None):
+        """
+        Checks `password` against the stored one, upgrading it if needed.
+        Checking is charged to `keys`, like in add_user.
+        """
+        rows = yield self._query(query.select_password, (nick,))
+        if not rows:
+            raise sqlite3.IntegrityError('no such user in database')
+
+        stored = rows[0][0]
+        correct, new_hash = yield self.passwords.check(password, stored, keys or {})
+        if new_hash is not None:
+            # Only replaces the password that was checked.
+            d = self._write(query.update_password, (new_hash, nick, stored))
+            d.addErrback(lambda f: log.err(f'DB: failed to rehash password of {nick}: {f.getErrorMessage()}'))
+        return correct
 
     @staticmethod
-    def _add_members(transaction, member_tuples):
-        transaction.executemany(query.insert_member, member_tuples)
+    def _mode(public):
+        return 'pub' if public == 1 else 'priv'
+
+    @classmethod
+    def _lock_channel(cls, transaction, channel_name):
+        # Take the write lock up front, so that nothing changes between
+        # the checks and the writes of a compound operation.
+        transaction.execute('BEGIN IMMEDIATE')
+        transaction.execute(query.select_channel_info, (channel_name,))
+        row = transaction.fetchone()
+        return (row[0], cls._mode(row[1])) if row else None
 
-    @log_operation
-    @defer.inlineCallbacks
+    def channel_exists(self, channel_name):
+        return defer.succeed(channel_name in self.directory.channels)
+
+    def _write_all(self, statement, params_list, on_commit):
+        """Queues writes, calling `on_commit(*params)` as each one commits."""
+        ds = [self._writes.write(statement, params, partial(on_commit, *params))
+              for params in params_list]
+        return defer.gatherResults(ds, consumeErrors=True).addErrback(first_error)
+
+    @operation
     def add_members(self, channel_name, nicks):
         member_tuples = [(nick, channel_name) for nick in nicks]
-        yield self._dbpool.runInteraction(self._add_members, member_tuples)
-
-    @staticmethod
-    def _delete_members(transaction, member_tuples):
-        transaction.executemany(query.delete_member, member_tuples)
+        return self._write_all(query.insert_member, member_tuples, self.directory.add_member)
 
-    @log_operation
-    @defer.inlineCallbacks
+    @operation
     def delete_members(self, channel_name, nicks):
         member_tuples = [(nick, channel_name) for nick in nicks]
-        yield self._dbpool.runInteraction(self._delete_members, member_tuples)
+        return self._write_all(query.delete_member, member_tuples, self.directory.delete_member)
 
-    @log_operation
-    @defer.inlineCallbacks
+    @staticmethod
+    def _add_channel(transaction, channel_name, creator, public, member_tuples):
+        transaction.execute(query.insert_channel, (channel_name, creator, int(public)))
+        transaction.executemany(query.insert_member, member_tuples)
+
+    @operation
     def add_channel(self, channel_name, creator, public=True, nicks=None):
-        yield self._dbpool.runOperation(query.insert_channel, (channel_name, creator, int(public)))
+        member_tuples = [(nick, channel_name) for nick in nicks or [] if not public]
 
-        if nicks and not public:
-            self.add_members(channel_name, nicks)
+        def committed(_):
+            self.directory.add_channel(channel_name, creator, 'pub' if public else 'priv')
+            for member_tuple in member_tuples:
+                self.directory.add_member(*member_tuple)
 
-    @log_operation
-    def delete_channel(self, channel_name):
-        return self._dbpool.runOperation(query.delete_channel, (channel_name,))
+        return self._transaction(self._add_channel, channel_name, creator,
+                                 public, member_tuples, on_commit=committed)
 
-    @log_operation
+    @operation
+    def delete_channel(self, channel_name):
+        return self._write(query.delete_channel, (channel_name,),
+                           on_commit=lambda _: self.directory.delete_channel(channel_name))
+
+    def join_channel(self, nick, channel_name):
+        """
+        Returns mode of the channel (None if there is no such channel)
+        and whether `nick` may join it.
+        """
+        info = self.directory.channels.get(channel_name)
+        if info is None:
+            return defer.succeed((None, False))
+
+        mode = info[1]
+        return defer.succeed((mode, mode == 'pub' or self.directory.is_member(nick, channel_name)))
+
+    def _check_admin(self, nick, channel_name):
+        # Commands of anyone but the creator of a private channel are
+        # rejected without going to the database.
+        info = self.directory.channels.get(channel_name)
+        if info != (nick, 'priv'):
+            creator, mode = info or (None, None)
+            return mode, creator, []
+
+    @classmethod
+    def _add_members_as(cls, transaction, nick, channel_name, nicks):
+        info = cls._lock_channel(transaction, channel_name)
+        if info != (nick, 'priv'):
+            return info, []
+
+        transaction.execute(query.select_nicks(len(nicks)), nicks)
+        valid_nicks = [r[0] for r in transaction.fetchall()]
+        transaction.executemany(query.insert_member, [(n, channel_name) for n in valid_nicks])
+        return info, valid_nicks
+
+    @operation
+    @defer.inlineCallbacks
+    def add_members_as(self, nick, channel_name, nicks):
+        """
+        Adds registered users among `nicks` to a private channel created
+        by `nick`. Returns mode and creator of the channel (both None if
+        there is no such channel) and the nicks added.
+        """
+        rejected = self._check_admin(nick, channel_name)
+        if rejected:
+            return rejected
+
+        def committed(result):
+            for member in result[1]:
+                self.directory.add_member(member, channel_name)
+
+        info, added = yield self._transaction(self._add_members_as,
+                                              nick, channel_name, nicks, on_commit=committed)
+
+        creator, mode = info or (None, None)
+        return mode, creator, added
+
+    @classmethod
+    def _kick_members_as(cls, transaction, nick, channel_name, nicks):
+        info = cls._lock_channel(transaction, channel_name)
+        if info != (nick, 'priv'):
+            return info, []
+
+        transaction.execute(query.select_nicks(len(nicks)), nicks)
+        valid_nicks = [r[0] for r in transaction.fetchall() if r[0] != nick]
+        transaction.executemany(query.delete_member, [(n, channel_name) for n in valid_nicks])
+        return info, valid_nicks
+
+    @operation
     @defer.inlineCallbacks
+    def kick_members_as(self, nick, channel_name, nicks):
+        """
+        Removes registered users among `nicks`, other than `nick` itself,
+        from a private channel created by `nick`. Returns mode and creator
+        of the channel (both None if there is no such channel) and the
+        nicks removed.
+        """
+        rejected = self._check_admin(nick, channel_name)
+        if rejected:
+            return rejected
+
+        def committed(result):
+            for member in result[1]:
+                self.directory.delete_member(member, channel_name)
+
+        info, kicked = yield self._transaction(self._kick_members_as,
+                                               nick, channel_name, nicks, on_commit=committed)
+
+        creator, mode = info or (None, None)
+        return mode, creator, kicked
+
+    @classmethod
+    def _delete_channel_as(cls, transaction, nick, channel_name):
+        info = cls._lock_channel(transaction, channel_name)
+        if info is None or info[0] != nick:
+            return info, []
+
+        members = []
+        if info[1] == 'priv':
+            transaction.execute(query.select_members, (channel_name,))
+            members = [r[0] for r in transaction.fetchall()]
+        transaction.execute(query.delete_channel, (channel_name,))
+        return info, members
+
+    @operation
+    @defer.inlineCallbacks
+    def delete_channel_as(self, nick, channel_name):
+        """
+        Deletes a channel if `nick` created it. Returns mode and creator
+        of the channel (both None if there is no such channel) and, for
+        a deleted private channel, its former members.
+        """
+        info = self.directory.channels.get(channel_name)
+        if info is None or info[0] != nick:
+            creator, mode = info or (None, None)
+            return mode, creator, []
+
+        def committed(result):
+            if result[0] is not None and result[0][0] == nick:
+                self.directory.delete_channel(channel_name)
+
+        info, members = yield self._transaction(self._delete_channel_as,
+                                                nick, channel_name, on_commit=committed)
+
+        creator, mode = info or (None, None)
+        return mode, creator, members
+
     def get_channel_creator(self, channel_name):
-        creator = yield self._dbpool.runQuery(query.select_creator, (channel_name,))
-        if creator:
-            return creator[0][0]
-        else:
-            return None
+        info = self.directory.channels.get(channel_name)
+        return defer.succeed(info[0] if info else None)
 
-    @log_operation
-    @defer.inlineCallbacks
     def get_channel_mode(self, channel_name):
-        mode = yield self._dbpool.runQuery(query.select_mode, (channel_name,))
-
-        if mode:
-            return 'pub' if mode[0][0] == 1 else 'priv'
-        else:
-            return None
+        info = self.directory.channels.get(channel_name)
+        return defer.succeed(info[1] if info else None)
 
-    @log_operation
-    @defer.inlineCallbacks
     def is_member(self, nick, channel_name):
-        result = yield self._dbpool.runQuery(query.select_is_member, (nick, channel_name))
-        return result != []
+        return defer.succeed(self.directory.is_member(nick, channel_name))
 
-    @log_operation
-    @defer.inlineCallbacks
     def get_pub_channels(self):
-        channels = yield self._dbpool.runQuery(query.select_pub_channels)
-        return [c[0] for c in channels]
+        return defer.succeed(self.directory.pub_channels())
 
-    @log_operation
-    @defer.inlineCallbacks
     def get_priv_channels(self, nick=None):
-        channels = yield self._dbpool.runQuery(query.select_priv_channels, (nick,))
-        return [c[0] for c in channels]
+        return defer.succeed(self.directory.priv_channels(nick))
 
-    @log_operation
+    @operation
     def add_notification(self, author, target, notification):
-        return self._dbpool.runOperation(query.insert_notification, (author, target, notification))
-
-    @log_operation
-    @defer.inlineCallbacks
-    def get_notifications(self, user):
-        results = yield self._dbpool.runQuery(query.select_notifications, (user,))
-        return results
+        return self._writes.write(query.insert_notification, (author, target, notification))
 
-    @log_operation
-    def delete_notifications(self, user):
-        return self._dbpool.runOperation(query.delete_notifications, (user,))
+    @staticmethod
+    def _take_notifications(transaction, user, limit):
+        transaction.execute(query.take_notifications, (user, limit))
+        return [row[1:] for row in sorted(transaction.fetchall())]
+
+    @operation
+    def take_notifications(self, user, limit):
+        """
+        Removes up to `limit` oldest notifications for `user` and returns
+        them as (author, content) pairs, oldest first. A batch taken after
+        the call was cancelled is put back.
+        """
+        def take(_):
+            def committed(notifications):
+                if taken.called:
+                    for author, content in notifications:
+                        w = self._writes.write(query.insert_notification, (author, user, content))
+                        w.addErrback(lambda _: log.err(f'DB: lost notification for {user}'))
+
+            taken = self._run(self._write_pool, self._take_notifications, user, limit, on_commit=committed)
+            return taken
+
+        # Like _transaction, but the batch is put back only if the
+        # interaction itself was cancelled.
+        return self._writes.flush().addCallback(take)
 
-    @log_operation
-    @defer.inlineCallbacks
     def get_members(self, channel):
-        results = yield self._dbpool.runQuery(query.select_members, (channel,))
-        return [r[0] for r in results]
+        return defer.succeed(self.directory.channel_members(channel))
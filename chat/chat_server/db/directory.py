@@ -0,0 +1,91 @@
+import sys
+from collections import defaultdict
+
+from chat.chat_server.db import query
+
+
+class Directory:
+    """
+    In-memory copy of registered users, channels and memberships.
+
+    DBService loads it at startup and applies its writes to it as they
+    commit, so it can answer lookups without touching the database.
+    Channels map to (creator, mode) pairs, where mode is 'pub' or 'priv'.
+    """
+
+    def __init__(self):
+        self.users = set()
+        self.channels = {}
+        self.members = defaultdict(set)
+        self.memberships = defaultdict(set)
+
+    def load(self, cursor):
+        self.users.clear()
+        self.channels.clear()
+        self.members.clear()
+        self.memberships.clear()
+
+        for nick, in cursor.execute(query.select_all_users):
+            self.add_user(nick)
+        for name, creator, public in cursor.execute(query.select_all_channels):
+            self.add_channel(name, creator, 'pub' if public == 1 else 'priv')
+        for nick, channel in cursor.execute(query.select_all_members):
+            self.add_member(nick, channel)
+
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'channels': len(self.channels),
+            'memberships': sum(len(m) for m in self.members.values()),
+        }
+
+    def add_user(self, nick):
+        self.users.add(sys.intern(nick))
+
+    def delete_user(self, nick):
+        # Mirrors cascades of the user's deletion.
+        self.users.discard(nick)
+        for name in [n for n, (creator, _) in self.channels.items() if creator == nick]:
+            self.delete_channel(name)
+        for channel in self.memberships.pop(nick, ()):
+            self._discard(self.members, channel, nick)
+
+    def add_channel(self, name, creator, mode):
+        self.channels[sys.intern(name)] = sys.intern(creator), mode
+
+    def delete_channel(self, name):
+        self.channels.pop(name, None)
+        for nick in self.members.pop(name, ()):
+            self._discard(self.memberships, nick, name)
+
+    def add_member(self, nick, channel):
+        nick, channel = sys.intern(nick), sys.intern(channel)
+        self.members[channel].add(nick)
+        self.memberships[nick].add(channel)
+
+    def delete_member(self, nick, channel):
+        self._discard(self.members, channel, nick)
+        self._discard(self.memberships, nick, channel)
+
+    @staticmethod
+    def _discard(index, key, value):
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del index[key]
+
+    def registered(self, nicks):
+        return [nick for nick in dict.fromkeys(nicks) if nick in self.users]
+
+    def is_member(self, nick, channel):
+        return channel in self.memberships.get(nick, ())
+
+    def pub_channels(self):
+        return [name for name, (_, mode) in self.channels.items() if mode == 'pub']
+
+    def priv_channels(self, nick):
+        return list(self.memberships.get(nick, ()))
+
+    def channel_members(self, channel):
+        return list(self.members.get(channel, ()))
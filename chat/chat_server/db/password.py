@@ -0,0 +1,104 @@
+import base64
+import hashlib
+import hmac
+import os
+from collections import Counter
+
+from twisted.internet import defer
+
+from chat import util
+
+SCHEME = 'scrypt'
+
+
+def _scrypt(password, salt, cost):
+    n, r = 2 ** cost, 8
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=1,
+                          maxmem=2 * 128 * r * n, dklen=32)
+
+
+def hash_password(password, cost):
+    """
+    Hashes `password` with scrypt, n = 2 ** `cost`. The cost and the salt
+    are stored along with the hash.
+    """
+    salt = os.urandom(16)
+    key = _scrypt(password, salt, cost)
+    return '$'.join([SCHEME, str(cost), base64.b64encode(salt).decode(), base64.b64encode(key).decode()])
+
+
+def check_password(password, stored, cost):
+    """
+    Returns whether `password` matches the `stored` one and, if it does
+    but was stored in plaintext or hashed at a lower cost than `cost`,
+    a new hash to store instead.
+    """
+    parts = stored.split('$')
+    if len(parts) == 4 and parts[0] == SCHEME:
+        stored_cost = int(parts[1])
+        salt, key = base64.b64decode(parts[2]), base64.b64decode(parts[3])
+        correct = hmac.compare_digest(_scrypt(password, salt, stored_cost), key)
+        outdated = stored_cost < cost
+    else:
+        # Stored before passwords were hashed.
+        correct = hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+        outdated = True
+
+    return correct, hash_password(password, cost) if correct and outdated else None
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords on a WorkerPool, so that a login storm
+    does not stall the reactor.
+
+    Each call is charged to its keys, e.g. {'ip': host, 'nick': nick},
+    and at most `limits[kind]` calls may be waiting or running for a
+    single key of a kind. Calls over a limit, or over the pool's
+    `max_queued`, fail with Overloaded.
+    """
+
+    def __init__(self, cost, workers, max_queued, limits):
+        self.cost = cost
+        self.limits = limits
+        self.pool = util.WorkerPool(workers, max_queued, name='password')
+
+        self._load = Counter()
+        self.rejected = 0
+
+    def start(self):
+        self.pool.start()
+
+    def stop(self):
+        self.pool.stop()
+
+    def stats(self):
+        return {**self.pool.stats(), 'rejected': self.rejected}
+
+    def hash(self, password, keys):
+        return self._submit(keys, hash_password, password, self.cost)
+
+    def check(self, password, stored, keys):
+        return self._submit(keys, check_password, password, stored, self.cost)
+
+    def _submit(self, keys, func, *args):
+        keys = list(keys.items())
+        for key in keys:
+            kind, _ = key
+            if kind in self.limits and self._load[key] >= self.limits[kind]:
+                self.rejected += 1
+                return defer.fail(util.Overloaded(f'Too many password checks for this {kind}.'))
+
+        for key in keys:
+            self._load[key] += 1
+
+        d = self.pool.submit(func, *args)
+        d.addBoth(self._release, keys)
+        return d
+
+    def _release(self, result, keys):
+        for key in keys:
+            self._load[key] -= 1
+            if not self._load[key]:
+                del self._load[key]
+        return result
@@ -33,6 +33,50 @@ create_table_notification = ('CREATE TABLE IF NOT EXISTS notification ('
                              'CONSTRAINT fk_targets '
                              'FOREIGN KEY (target) REFERENCES user (nick) ON DELETE CASCADE);')
 
+# Indexes.
+delete_duplicate_members = ('DELETE FROM is_member '
+                            'WHERE id NOT IN (SELECT MIN(id) '
+                            'FROM is_member '
+                            'GROUP BY user, channel)')
+
+create_index_member_user = ('CREATE UNIQUE INDEX IF NOT EXISTS is_member_user '
+                            'ON is_member (user, channel)')
+
+create_index_member_channel = ('CREATE INDEX IF NOT EXISTS is_member_channel '
+                               'ON is_member (channel, user)')
+
+create_index_channel_public = ('CREATE INDEX IF NOT EXISTS channel_public '
+                               'ON channel (public, name)')
+
+create_index_channel_creator = ('CREATE INDEX IF NOT EXISTS channel_creator '
+                                'ON channel (creator)')
+
+create_index_notification_target = ('CREATE INDEX IF NOT EXISTS notification_target '
+                                    'ON notification (target)')
+
+create_index_notification_author = ('CREATE INDEX IF NOT EXISTS notification_author '
+                                    'ON notification (author)')
+
+# Schema versions, each one reached by running its statements on the
+# previous one. Append new versions, never change existing ones.
+migrations = [
+    [
+        create_table_user,
+        create_table_channel,
+        create_table_is_member,
+        create_table_notification,
+    ],
+    [
+        delete_duplicate_members,
+        create_index_member_user,
+        create_index_member_channel,
+        create_index_channel_public,
+        create_index_channel_creator,
+        create_index_notification_target,
+        create_index_notification_author,
+    ],
+]
+
 # Lookups.
 select_nick = ('SELECT nick '
                'FROM user '
@@ -53,37 +97,25 @@ select_password = ('SELECT password '
                    'FROM user '
                    'WHERE nick = ?')
 
-select_channel = ('SELECT name '
-                  'FROM channel '
-                  'WHERE name = ?')
-
-select_creator = ('SELECT creator '
-                  'FROM channel '
-                  'WHERE name = ?')
-
-select_mode = ('SELECT public '
-               'FROM channel '
-               'WHERE name = ?')
-
-select_is_member = ('SELECT user, channel '
-                    'FROM is_member '
-                    'WHERE user = ? AND channel = ?')
+# Rechecks a channel under the write lock of a compound operation,
+# plain lookups go to the in-memory Directory.
+select_channel_info = ('SELECT creator, public '
+                       'FROM channel '
+                       'WHERE name = ?')
 
 select_members = ('SELECT user '
                   'FROM is_member '
                   'WHERE channel = ?')
 
-select_pub_channels = ('SELECT name '
-                       'FROM channel '
-                       'WHERE public = 1')
+# Bulk loads.
+select_all_users = ('SELECT nick '
+                    'FROM user')
 
-select_priv_channels = ('SELECT DISTINCT channel '
-                        'FROM is_member '
-                        'WHERE user = ?')
+select_all_channels = ('SELECT name, creator, public '
+                       'FROM channel')
 
-select_notifications = ('SELECT author, content '
-                        'FROM notification '
-                        'WHERE target = ?')
+select_all_members = ('SELECT user, channel '
+                      'FROM is_member')
 
 # Insertion.
 insert_user = ('INSERT INTO user(nick, mail, password) '
@@ -92,12 +124,17 @@ insert_user = ('INSERT INTO user(nick, mail, password) '
 insert_channel = ('INSERT INTO channel(name, creator, public) '
                   'VALUES (?, ?, ?)')
 
-insert_member = ('INSERT INTO is_member(user, channel) '
+insert_member = ('INSERT OR IGNORE INTO is_member(user, channel) '
                  'VALUES (?, ?)')
 
 insert_notification = ('INSERT INTO notification(author, target, content) '
                        'VALUES (?, ?, ?)')
 
+# Update.
+update_password = ('UPDATE user '
+                   'SET password = ? '
+                   'WHERE nick = ? AND password = ?')
+
 # Deletion.
 delete_user = ('DELETE FROM user '
                'WHERE nick = ?')
@@ -108,5 +145,10 @@ delete_channel = ('DELETE FROM channel '
 delete_member = ('DELETE FROM is_member '
                  'WHERE user = ? AND channel = ?')
 
-delete_notifications = ('DELETE FROM notification '
-                        'WHERE target = ?')
\ No newline at end of file
+take_notifications = ('DELETE FROM notification '
+                      'WHERE notif_id IN (SELECT notif_id '
+                      'FROM notification '
+                      'WHERE target = ? '
+                      'ORDER BY notif_id '
+                      'LIMIT ?) '
+                      'RETURNING notif_id, author, content')
\ No newline at end of file
@@ -1,89 +1,114 @@
-from functools import wraps
-from twisted.python import log
-
 from chat.chat_server import dispatch
 from chat.chat_server.peer import ChatClient, ChatServer
 
 
-def log_operation(method):
-    @wraps(method)
-    def wrapper(*args, **kwargs):
-        log.msg(f'DISPATCH: {method.__name__} CALLED')
-        return method(*args, **kwargs)
-
-    return wrapper
-
-
 class Dispatcher:
+    instrumented = ('add_peer', 'remove_peer', 'add_channel', 'remove_channel',
+                    'is_on', 'names', 'subscribe', 'unsubscribe',
+                    'get_peers', 'publish', 'notify')
+
     def __init__(self, channels=None):
         self.user2peer = {}
         self.server_peers = set()
         self.channels = {}
 
+        # Reverse indexes of user2peer and Channel.users.
+        self.peer2users = {}
+        self.user2channels = {}
+        self.instrumentation = None
+
         if channels:
             for ch_name in channels:
                 self.add_channel(ch_name)
 
-    @log_operation
+    def instrument(self, instrumentation):
+        """
+        Times every call of `instrumented` methods. Wrappers are set on the
+        instance only, so that an uninstrumented dispatcher pays nothing.
+        """
+        self.uninstrument()
+        self.instrumentation = instrumentation
+        for name in self.instrumented:
+            setattr(self, name, instrumentation.wrap(name, getattr(self, name)))
+
+    def uninstrument(self):
+        self.instrumentation = None
+        for name in self.instrumented:
+            self.__dict__.pop(name, None)
+
     def add_peer(self, peer, nick=None):
         if nick:
+            old_peer = self.user2peer.get(nick, None)
+            if old_peer is not None and old_peer is not peer:
+                self._forget_user(old_peer, nick)
+
             self.user2peer[nick] = peer
+            self.peer2users.setdefault(peer, set()).add(nick)
         else:
             self.server_peers.add(peer)
 
-    # pretty terrible, short on time
-    @log_operation
     def remove_peer(self, peer, nick=None):
         if isinstance(peer, ChatClient):
-            if not nick:
-                for k, v in self.user2peer.items():
-                    if v == peer:
-                        nick = k
-                        break
-            self.user2peer.pop(nick, None)
-
-            for c in self.channels.values():
-                c.unregister_user(nick)
+            nicks = {nick} if nick else self.peer2users.get(peer, set()).copy()
+            for n in nicks:
+                self._forget_user(peer, n)
+                for channel_name in self.user2channels.pop(n, ()):
+                    self.channels[channel_name].unregister_user(n)
         elif isinstance(peer, ChatServer):
-            nicks = []
-            for k, v in self.user2peer.items():
-                if v == peer:
-                    nicks.append(k)
             self.server_peers.remove(peer)
-            for n in nicks:
+            for n in self.peer2users.pop(peer, ()):
                 self.user2peer.pop(n, None)
 
-    @log_operation
+    def _forget_user(self, peer, nick):
+        if self.user2peer.get(nick, None) is peer:
+            del self.user2peer[nick]
+
+        nicks = self.peer2users.get(peer, None)
+        if nicks is not None:
+            nicks.discard(nick)
+            if not nicks:
+                del self.peer2users[peer]
+
     def add_channel(self, channel_name, replace=True):
         if channel_name not in self.channels.keys() or replace:
+            self._drop_channel(channel_name)
             self.channels[channel_name] = dispatch.Channel(self, channel_name)
 
-    @log_operation
     def remove_channel(self, channel_name):
-        self.channels.pop(channel_name, None)
+        self._drop_channel(channel_name)
+
+    def _drop_channel(self, channel_name):
+        channel = self.channels.pop(channel_name, None)
+        if channel:
+            for nick in channel.users:
+                self._unindex_subscription(channel_name, nick)
+
+    def _unindex_subscription(self, channel_name, nick):
+        channel_names = self.user2channels.get(nick, None)
+        if channel_names is not None:
+            channel_names.discard(channel_name)
+            if not channel_names:
+                del self.user2channels[nick]
 
-    @log_operation
     def is_on(self, nicks):
         return list(set(nicks) & set(self.user2peer.keys()))
 
-    @log_operation
     def names(self, channel_name):
         channel = self.channels.get(channel_name, None)
         return channel.names() if channel else set()
 
-    @log_operation
     def subscribe(self, channel_name, nick):
         channel = self.channels.get(channel_name, None)
         if channel:
             channel.register_user(nick)
+            self.user2channels.setdefault(nick, set()).add(channel_name)
 
-    @log_operation
     def unsubscribe(self, channel_name, nick):
         channel = self.channels.get(channel_name, None)
         if channel:
             channel.unregister_user(nick)
+            self._unindex_subscription(channel_name, nick)
 
-    @log_operation
     def get_peers(self, names, local_only=True):
         peers = [self.user2peer[nick] for nick in names if nick in names]
         if local_only:
@@ -91,7 +116,6 @@ class Dispatcher:
 
         return set(peers)
 
-    @log_operation
     def publish(self, channel_name, author, message, locally=False):
         if channel_name == 'servers':
             for s in self.server_peers - {author}:
@@ -101,7 +125,6 @@ class Dispatcher:
             if channel:
                 channel.publish(author, message, locally)
 
-    @log_operation
     def notify(self, nick, notification):
         peer = self.user2peer[nick]
         peer.receive(notification)
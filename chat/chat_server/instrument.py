@@ -0,0 +1,78 @@
+import random
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+
+from twisted.python import log
+
+
+class Histogram:
+    """
+    Latency histogram with fixed, roughly exponential buckets.
+
+    Bounds are upper limits of buckets in seconds, the last bucket
+    counts everything slower than the last bound.
+    """
+
+    bounds = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, elapsed):
+        self.buckets[bisect_left(self.bounds, elapsed)] += 1
+        self.count += 1
+        self.total += elapsed
+
+    def as_dict(self):
+        labels = [f'<={b}' for b in self.bounds] + [f'>{self.bounds[-1]}']
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+
+class Instrumentation:
+    """
+    Per-operation latency histograms (which count calls, too).
+
+    Operations are timed by functions returned from `wrap`. A fraction
+    `sample_rate` of calls is also traced to the log, along with its
+    arguments.
+    """
+
+    def __init__(self, name, sample_rate=0.0):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.latency = defaultdict(Histogram)
+
+    def wrap(self, operation, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(operation, time.perf_counter() - start)
+                if self.sample_rate and random.random() < self.sample_rate:
+                    log.msg(f'{self.name}: {operation} CALLED with {args} {kwargs}')
+
+        return wrapper
+
+    def observe(self, operation, elapsed):
+        self.latency[operation].observe(elapsed)
+
+    def stats(self):
+        return {op: hist.as_dict() for op, hist in self.latency.items()}
+
+    def dump(self):
+        for op, stats in sorted(self.stats().items()):
+            log.msg(f'{self.name}: {op} calls={stats["count"]} '
+                    f'mean={stats["mean"] * 1000:.3f}ms buckets={stats["buckets"]}')
+
+    def reset(self):
+        self.latency.clear()
@@ -1,3 +1,6 @@
+import time
+
+from twisted.internet import defer
 from twisted.python import log
 
 import chat.communication as comm
@@ -15,6 +18,12 @@ class Peer:
     def receive(self, message):
         self.state.handle_broadcast(message)
 
+    def output_stats(self):
+        return self.protocol.output_stats()
+
+    def remote_host(self):
+        return getattr(self.protocol.transport.getPeer(), 'host', None)
+
     def lose_connection(self):
         self.protocol.unregister_subscriber()
         self.protocol.loseConnection()
@@ -26,6 +35,33 @@ class Peer:
 
 
 class State(comm.MessageSubscriber):
+    """
+    Handles messages and broadcasts with its msg_COMMAND and brd_COMMAND
+    methods. Tables mapping commands to them are built once per class.
+
+    If `instrumentation` is set, it observes how long each handler
+    takes - until its Deferred fires, for the asynchronous ones.
+
+    A connection keeps one State object for its lifetime and `switch`es
+    its class to change state.
+    """
+
+    __slots__ = ('endpoint', 'manager', 'connected')
+
+    instrumentation = None
+    _msg_handlers = {}
+    _brd_handlers = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._msg_handlers = cls._handler_table('msg_')
+        cls._brd_handlers = cls._handler_table('brd_')
+
+    @classmethod
+    def _handler_table(cls, prefix):
+        return {name[len(prefix):]: getattr(cls, name)
+                for name in dir(cls)
+                if name.startswith(prefix) and name != prefix + 'unknown'}
 
     def __init__(self, protocol, endpoint, manager):
         protocol.register_subscriber(self)
@@ -34,20 +70,34 @@ class State(comm.MessageSubscriber):
         self.connected = True
         self.log_msg('starting...')
 
+    def switch(self, state_cls, *args, **kwargs):
+        """
+        Turns this object into a `state_cls` instance and enters that state.
+        `state_cls` must not add slots to the ones of this object's class.
+        """
+        self.__class__ = state_cls
+        self.enter(*args, **kwargs)
+
+    def enter(self):
+        """Called after switching to this state."""
+        pass
+
     def on_connection_closed(self):
         self.connected = False
         self.manager.on_connection_closed()
         self.log_msg('connection closed')
 
     def handle_message(self, message):
-        method_name = f'msg_{message.command}'
-        method = getattr(self, method_name, None)
+        handler = self._msg_handlers.get(message.command, None)
 
-        if method is None:
+        if handler is None:
             self.msg_unknown(message)
         else:
             try:
-                method(message)
+                if self.instrumentation:
+                    self._call_timed(handler, message)
+                else:
+                    handler(self, message)
             except ValueError:
                 self.log_err('wrong number of params')
 
@@ -57,13 +107,28 @@ class State(comm.MessageSubscriber):
         self.log_err(f'received message {cmd} with params: {params}')
 
     def handle_broadcast(self, message):
-        method_name = f'brd_{message.command}'
-        method = getattr(self, method_name, None)
+        handler = self._brd_handlers.get(message.command, None)
 
-        if method is None:
+        if handler is None:
             self.brd_unknown(message)
+        elif self.instrumentation:
+            self._call_timed(handler, message)
+        else:
+            handler(self, message)
+
+    def _call_timed(self, handler, message):
+        operation = handler.__qualname__
+        start = time.perf_counter()
+
+        def observe(result):
+            self.instrumentation.observe(operation, time.perf_counter() - start)
+            return result
+
+        result = handler(self, message)
+        if isinstance(result, defer.Deferred):
+            result.addBoth(observe)
         else:
-            method(message)
+            observe(result)
 
     def brd_unknown(self, message):
         cmd = message.command
@@ -1,9 +1,10 @@
-from twisted.python import failure
 from twisted.internet import defer
 
 from chat import communication as comm
+from chat import config
 from chat import util
 from chat.chat_server import peer
+from chat.chat_server.db import DBError
 
 
 class ChatClientEndpoint(comm.Endpoint):
@@ -121,9 +122,19 @@ class ChatClientEndpoint(comm.Endpoint):
     def msg(self, from_user, channel, content):
         self.send(f':{from_user} MSG {channel} :{content}')
 
+    def msg_broadcast(self, message, channel):
+        if message.encoded is None:
+            content = message.params[-1]
+            message.encoded = comm.encode_line(f':{message.prefix} MSG {channel} :{content}')
+        self.send_encoded(message.encoded)
+
     def notified(self, notifies, notification):
         self.send(f'NOTIFIED {notifies} :{notification}')
 
+    def notified_many(self, notifications):
+        self.send_lines(f'NOTIFIED {notifies} :{notification}'
+                        for notifies, notification in notifications)
+
     def bad_operation(self, operation):
         self.send(f'ERR_BAD_OP :{operation}')
 
@@ -159,7 +170,47 @@ class ChatClientEndpoint(comm.Endpoint):
         self.send('RPL_HELP : -> /DELETE - delete the channel')
 
 
-class InitialState(peer.State):
+class ClientState(peer.State):
+    """
+    State of a chat client connection. ChatClient creates one per
+    connection and switches it between the states below, which add
+    handlers but no slots.
+    """
+
+    __slots__ = ('db', 'dispatcher', 'ai_conn', 'nick', 'channel', 'mode', 'admin',
+                 'reg_deferred', 'login_deferred', 'password_countdown')
+
+    def __init__(self, protocol, endpoint, db, dispatcher, ai_conn, manager):
+        super().__init__(protocol, endpoint, manager)
+
+        self.db = db
+        self.dispatcher = dispatcher
+        self.ai_conn = ai_conn
+        self.nick = None
+        self.channel = None
+        self.mode = None
+        self.admin = None
+        self.reg_deferred = None
+        self.login_deferred = None
+        self.password_countdown = 0
+
+    def _notify(self, nick, content):
+        """Notifies `nick` now if online, otherwise when they log in."""
+        if self.dispatcher.is_on([nick]):
+            notification = comm.Message(command='NOTIFIED', params=[self.nick, nick, content])
+            self.dispatcher.notify(nick, notification)
+        else:
+            d = self.db.add_notification(self.nick, nick, content)
+            d.addErrback(lambda _: self.log_err(f'failed to store notification for {nick}'))
+
+    def _password_keys(self, nick):
+        """Keys password hashing for `nick` on this connection is limited by."""
+        return {'ip': self.manager.remote_host(), 'nick': nick}
+
+
+class InitialState(ClientState):
+    __slots__ = ()
+
     def msg_REGISTER(self, message):
         self.manager.state_registering(message)
 
@@ -172,12 +223,10 @@ class InitialState(peer.State):
         super().msg_unknown(message)
 
 
-class RegisteringState(peer.State):
-    def __init__(self, protocol, endpoint, db, dispatcher, manager):
-        super().__init__(protocol, endpoint, manager)
+class RegisteringState(ClientState):
+    __slots__ = ()
 
-        self.db = db
-        self.dispatcher = dispatcher
+    def enter(self):
         self.reg_deferred = None
 
     @defer.inlineCallbacks
@@ -196,13 +245,15 @@ class RegisteringState(peer.State):
                 @defer.inlineCallbacks
                 def on_password_received(password):
                     try:
-                        yield self.db.add_user(nick, mail, password)
+                        yield self.db.add_user(nick, mail, password, self._password_keys(nick))
                         self.endpoint.registered(nick, mail, password)
                         msg = comm.Message(command='OK_REG', params=[nick, mail, password])
                         self.dispatcher.publish('servers', self.manager, msg)
 
                         self.manager.state_logged_in(nick)
-                    except failure.Failure:
+                    except util.Overloaded:
+                        self.endpoint.internal_error('Server busy, please try again later.')
+                    except DBError:
                         self.endpoint.internal_error('DB error, please try again.')
 
                 def on_request_cancelled(_):
@@ -216,7 +267,7 @@ class RegisteringState(peer.State):
                     self.endpoint.taken(mail, 'mail')
                 else:
                     self.endpoint.taken(nick, 'nick')
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     def msg_PASSWORD(self, message):
@@ -233,12 +284,10 @@ class RegisteringState(peer.State):
         super().on_connection_closed()
 
 
-class LoggingInState(peer.State):
-    def __init__(self, protocol, endpoint, db, dispatcher, manager):
-        super().__init__(protocol, endpoint, manager)
+class LoggingInState(ClientState):
+    __slots__ = ()
 
-        self.db = db
-        self.dispatcher = dispatcher
+    def enter(self):
         self.login_deferred = None
         self.password_countdown = 3
 
@@ -257,7 +306,8 @@ class LoggingInState(peer.State):
                 @defer.inlineCallbacks
                 def on_password_received(password):
                     try:
-                        password_correct = yield self.db.password_correct(nick, password)
+                        password_correct = yield self.db.password_correct(nick, password,
+                                                                          self._password_keys(nick))
                         if password_correct:
                             self.manager.state_logged_in(nick)
                         else:
@@ -270,7 +320,9 @@ class LoggingInState(peer.State):
                             else:
                                 self.endpoint.connection_closed('Too many password retries.')
                                 self.manager.lose_connection()
-                    except failure.Failure:
+                    except util.Overloaded:
+                        self.endpoint.internal_error('Server busy, please try again later.')
+                    except DBError:
                         self.endpoint.internal_error('DB error, please try again.')
 
                 def on_request_cancelled(_):
@@ -282,7 +334,7 @@ class LoggingInState(peer.State):
             else:
                 self.endpoint.no_user(nick)
                 self.manager.state_init()
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     def msg_PASSWORD(self, message):
@@ -299,13 +351,12 @@ class LoggingInState(peer.State):
         super().on_connection_closed()
 
 
-class LoggedInState(peer.State):
-    def __init__(self, protocol, endpoint, db, dispatcher, manager, nick, starting=True):
-        super().__init__(protocol, endpoint, manager)
+class LoggedInState(ClientState):
+    __slots__ = ()
 
-        self.db = db
-        self.dispatcher = dispatcher
+    def enter(self, nick, starting=True):
         self.nick = nick
+        self.channel = None
 
         if starting:
             self.endpoint.logged_in(nick)
@@ -314,23 +365,30 @@ class LoggedInState(peer.State):
             self.dispatcher.publish('servers', self.manager, msg)
             self.dispatcher.add_peer(self.manager, nick)
 
-        # Notify fresher.
-        d = self.db.get_notifications(self.nick)
-
-        def notify(notifications):
-            for author, content in notifications:
-                self.endpoint.notified(author, content)
+            self._deliver_notifications()
 
-        def del_notifications(_):
-            d = self.db.delete_notifications(self.nick)
-            from twisted.internet import reactor
-            d.addTimeout(1, reactor)
-
-        from twisted.internet import reactor
-        d.addTimeout(1, reactor)
+    @defer.inlineCallbacks
+    def _deliver_notifications(self):
+        # Notifications are removed from the database as they are taken,
+        # a batch taken after the connection was lost is put back.
+        nick = self.nick
+        batch_size = config.notification_batch_size
 
-        d.addCallback(notify)
-        d.addCallback(del_notifications)
+        try:
+            while True:
+                notifications = yield self.db.take_notifications(nick, batch_size)
+                if not self.connected:
+                    for author, content in notifications:
+                        d = self.db.add_notification(author, nick, content)
+                        d.addErrback(lambda _: self.log_err(f'lost notification for {nick}'))
+                    return
+
+                if notifications:
+                    self.endpoint.notified_many(notifications)
+                if len(notifications) < batch_size:
+                    return
+        except DBError:
+            self.log_err(f'failed to deliver notifications to {nick}')
 
     def msg_LOGOUT(self, _):
         self.endpoint.logged_out(self.nick)
@@ -353,7 +411,7 @@ class LoggedInState(peer.State):
 
             self.endpoint.unregistered(self.nick)
             self.manager.lose_connection()
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     def msg_ISON(self, message):
@@ -400,15 +458,10 @@ class LoggedInState(peer.State):
                         if nick != self.nick:
                             content = f'You were added to channel {channel_name}!'
 
-                            if self.dispatcher.is_on([nick]):
-                                notification = comm.Message(command='NOTIFIED',
-                                                            params=[self.nick, nick, content])
-                                self.dispatcher.notify(nick, notification)
-                            else:
-                                self.db.add_notification(self.nick, nick, content)
+                            self._notify(nick, content)
             elif self.connected:
                 self.endpoint.channel_exists(channel_name)
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     @defer.inlineCallbacks
@@ -416,29 +469,17 @@ class LoggedInState(peer.State):
         channel_name = message.params[0]
 
         try:
-            creator = yield self.db.get_channel_creator(channel_name)
+            mode, creator, members = yield self.db.delete_channel_as(self.nick, channel_name)
 
             if creator:
                 if creator == self.nick:
-                    try:
-                        mode = yield self.db.get_channel_mode(channel_name)
-                        if mode == 'priv':
-                            content = f'Channel {channel_name} was deleted!'
-                            members = yield self.db.get_members(channel_name)
-                            on_channel = self.dispatcher.names(channel_name)
-
-                            for nick in set(members) - on_channel:
-                                if nick != self.nick:
-                                    if self.dispatcher.is_on([nick]):
-                                        notification = comm.Message(command='NOTIFIED',
-                                                                    params=[self.nick, nick, content])
-                                        self.dispatcher.notify(nick, notification)
-                                    else:
-                                        self.db.add_notification(self.nick, nick, content)
-                    except failure.Failure:
-                        self.log_err(f'failed to send notifications upon {channel_name} deletion.')
-
-                    yield self.db.delete_channel(channel_name)
+                    if mode == 'priv':
+                        content = f'Channel {channel_name} was deleted!'
+                        on_channel = self.dispatcher.names(channel_name)
+
+                        for nick in set(members) - on_channel:
+                            if nick != self.nick:
+                                self._notify(nick, content)
 
                     msg = comm.Message(command='OK_DELETED', params=[channel_name])
                     self.dispatcher.publish(channel_name, self.manager, msg, locally=True)
@@ -452,7 +493,7 @@ class LoggedInState(peer.State):
                     self.endpoint.no_perms('DELETE', 'You are not creator of this channel.')
             elif self.connected:
                 self.endpoint.no_channel(channel_name)
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     @defer.inlineCallbacks
@@ -464,7 +505,7 @@ class LoggedInState(peer.State):
             if self.connected:
                 self.endpoint.list(['pub'] + pub_channels)
                 self.endpoint.list(['priv'] + priv_channels)
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     @defer.inlineCallbacks
@@ -472,14 +513,12 @@ class LoggedInState(peer.State):
         channel_name = message.params[0]
 
         try:
-            mode = yield self.db.get_channel_mode(channel_name)
+            mode, may_join = yield self.db.join_channel(self.nick, channel_name)
 
             if mode:
-                if mode == 'priv':
-                    is_member = yield self.db.is_member(self.nick, channel_name)
-                    if not is_member:
-                        self.endpoint.no_perms('JOIN', 'You are not a member of this channel.')
-                        return
+                if not may_join:
+                    self.endpoint.no_perms('JOIN', 'You are not a member of this channel.')
+                    return
 
                 self.dispatcher.add_channel(channel_name, replace=False)
 
@@ -491,7 +530,7 @@ class LoggedInState(peer.State):
                 if self.connected:
                     self.endpoint.no_channel(channel_name)
             pass
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     @defer.inlineCallbacks
@@ -505,7 +544,7 @@ class LoggedInState(peer.State):
                 if mode == 'priv':
                     is_member = yield self.db.is_member(self.nick, channel)
                     if is_member:
-                        self.db.delete_members(channel, [self.nick])
+                        yield self.db.delete_members(channel, [self.nick])
                         if self.connected:
                             self.endpoint.user_quit(channel, self.nick)
 
@@ -516,11 +555,11 @@ class LoggedInState(peer.State):
                         msg = comm.Message(prefix='INFO', command='MSG', params=[content])
                         self.dispatcher.publish(channel, self.manager, msg)
                     else:
-                        self.endpoint.no_member(self.nick, channel)
+                        self.endpoint.not_member(self.nick, channel)
             else:
                 if self.connected:
                     self.endpoint.no_channel(channel)
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     @defer.inlineCallbacks
@@ -528,13 +567,10 @@ class LoggedInState(peer.State):
         channel, *nicks = message.params
 
         try:
-            mode = yield self.db.get_channel_mode(channel)
+            mode, creator, valid_nicks = yield self.db.add_members_as(self.nick, channel, nicks)
             if mode == 'priv':
-                creator = yield self.db.get_channel_creator(channel)
                 if creator == self.nick:
-                    valid_nicks = yield self.db.users_registered(nicks)
                     if valid_nicks:
-                        yield self.db.add_members(channel, valid_nicks)
                         if self.connected:
                             self.endpoint.added(channel, valid_nicks)
                             for nick in set(nicks) - set(valid_nicks):
@@ -550,19 +586,14 @@ class LoggedInState(peer.State):
                         for nick in valid_nicks:
                             content = f'You were added to channel {channel}!'
 
-                            if self.dispatcher.is_on([nick]):
-                                notification = comm.Message(command='NOTIFIED',
-                                                            params=[self.nick, nick, content])
-                                self.dispatcher.notify(nick, notification)
-                            else:
-                                self.db.add_notification(self.nick, nick, content)
+                            self._notify(nick, content)
                 else:
                     self.endpoint.no_perms('ADD', 'You are not creator of this channel.')
             elif mode == 'pub':
                 self.endpoint.bad_operation('add members to a public channel')
             else:
                 self.endpoint.no_channel(channel)
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     @defer.inlineCallbacks
@@ -570,20 +601,11 @@ class LoggedInState(peer.State):
         channel, *nicks = message.params
 
         try:
-            mode = yield self.db.get_channel_mode(channel)
+            mode, creator, valid_nicks = yield self.db.kick_members_as(self.nick, channel, nicks)
 
             if mode == 'priv':
-                creator = yield self.db.get_channel_creator(channel)
-
                 if creator == self.nick:
-                    valid_nicks = yield self.db.users_registered(nicks)
                     if valid_nicks:
-                        try:
-                            valid_nicks.remove(self.nick)
-                        except ValueError:
-                            pass
-
-                        yield self.db.delete_members(channel, valid_nicks)
                         if self.connected:
                             self.endpoint.kicked(channel, valid_nicks)
                             for nick in set(nicks) - set(valid_nicks):
@@ -603,19 +625,14 @@ class LoggedInState(peer.State):
                         for nick in set(valid_nicks) - on_channel:
                             content = f'You were kicked from channel {channel}!'
 
-                            if self.dispatcher.is_on([nick]):
-                                notification = comm.Message(command='NOTIFIED',
-                                                            params=[self.nick, nick, content])
-                                self.dispatcher.notify(nick, notification)
-                            else:
-                                self.db.add_notification(self.nick, nick, content)
+                            self._notify(nick, content)
                 else:
                     self.endpoint.no_perms('KICK', 'You are not creator of this channel.')
             elif mode == 'pub':
                 self.endpoint.bad_operation('kick users from a public channel')
             else:
                 self.endpoint.no_channel(channel)
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     def brd_NOTIFIED(self, message):
@@ -623,18 +640,14 @@ class LoggedInState(peer.State):
         self.endpoint.notified(who, content)
 
 
-class ConversationState(peer.State):
-
-    def __init__(self, protocol, endpoint, db, dispatcher, manager, ai_conn, nick, channel_name):
-        super().__init__(protocol, endpoint, manager)
+class ConversationState(ClientState):
+    __slots__ = ()
 
-        self.db = db
-        self.dispatcher = dispatcher
+    def enter(self, nick, channel_name):
         self.nick = nick
         self.channel = channel_name
         self.mode = None
         self.admin = None
-        self.ai_conn = ai_conn
 
         self.endpoint.user_joined(channel_name, nick)
         self.dispatcher.subscribe(channel_name, self.nick)
@@ -643,29 +656,27 @@ class ConversationState(peer.State):
         msg = comm.Message(prefix='INFO', command='MSG', params=[content])
         self.dispatcher.publish(channel_name, self.manager, msg)
 
+    # Results are cached only if the client is still on the same channel,
+    # as this object outlives the conversation.
     @defer.inlineCallbacks
     def _get_admin(self):
         if self.admin:
             return self.admin
-        try:
-            creator = yield self.db.get_channel_creator(self.channel)
-            if creator:
-                self.admin = creator
-            return creator
-        except failure.Failure:
-            raise
+        channel = self.channel
+        creator = yield self.db.get_channel_creator(channel)
+        if creator and self.channel == channel:
+            self.admin = creator
+        return creator
 
     @defer.inlineCallbacks
     def _get_mode(self):
         if self.mode:
             return self.mode
-        try:
-            mode = yield self.db.get_channel_mode(self.channel)
-            if mode:
-                self.mode = mode
-            return mode
-        except failure.Failure:
-            raise
+        channel = self.channel
+        mode = yield self.db.get_channel_mode(channel)
+        if mode and self.channel == channel:
+            self.mode = mode
+        return mode
 
     def msg_NAMES(self, _):
         names = self.dispatcher.names(self.channel)
@@ -687,7 +698,7 @@ class ConversationState(peer.State):
             admin = yield self._get_admin()
             if admin == self.nick:
                 self.endpoint.help_conversation_admin()
-        except failure.Failure:
+        except DBError:
             self.log_err(f'failed to get admin for {self.channel}')
 
     def msg_LEAVE(self, _):
@@ -701,25 +712,29 @@ class ConversationState(peer.State):
 
     @defer.inlineCallbacks
     def msg_QUIT(self, _):
+        channel = self.channel
         try:
             mode = yield self._get_mode()
             if mode == 'pub' or not mode:
                 self.endpoint.bad_operation('quit from a public channel')
                 return
 
-            self.db.delete_members(self.channel, [self.nick])
+            d = self.db.delete_members(channel, [self.nick])
+            d.addErrback(lambda _: self.log_err(f'failed to quit {self.nick} from {channel}'))
 
-            msg = comm.Message(command='USR_QUIT', params=[self.channel, self.nick])
+            msg = comm.Message(command='USR_QUIT', params=[channel, self.nick])
             self.dispatcher.publish('servers', self.manager, msg)
 
             content = util.mark(f'Member quit: {self.nick}', 'GREEN')
             msg = comm.Message(prefix='INFO', command='MSG', params=[content])
-            self.dispatcher.publish(self.channel, self.manager, msg)
-            self.dispatcher.unsubscribe(self.channel, self.nick)
+            self.dispatcher.publish(channel, self.manager, msg)
+            self.dispatcher.unsubscribe(channel, self.nick)
 
-            self.endpoint.user_quit(self.channel, self.nick)
-            self.manager.state_logged_in(self.nick, starting=False)
-        except failure.Failure:
+            if self.connected:
+                self.endpoint.user_quit(channel, self.nick)
+            if self.channel == channel:
+                self.manager.state_logged_in(self.nick, starting=False)
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     # TODO: this duplication (well, I guess not only it) shows that commands probably deserve
@@ -727,138 +742,106 @@ class ConversationState(peer.State):
     @defer.inlineCallbacks
     def msg_ADD(self, message):
         _, *nicks = message.params
+        channel = self.channel
 
         try:
-            admin = yield self._get_admin()
-            if admin != self.nick:
+            mode, creator, valid_nicks = yield self.db.add_members_as(self.nick, channel, nicks)
+            if creator != self.nick:
                 self.endpoint.no_perms('ADD', 'You are not creator of this channel.')
                 return
-        except failure.Failure:
-            self.log_err(f'failed to get admin for {self.channel}')
-            return
+            if mode == 'pub':
+                self.endpoint.bad_operation('add members to a public channel')
+                return
 
-        try:
-            valid_nicks = yield self.db.users_registered(nicks)
             if valid_nicks:
-                yield self.db.add_members(self.channel, valid_nicks)
                 if self.connected:
-                    self.endpoint.added(self.channel, valid_nicks)
+                    self.endpoint.added(channel, valid_nicks)
 
-                msg = comm.Message(command='ADDED', params=[self.channel, *valid_nicks])
+                msg = comm.Message(command='ADDED', params=[channel, *valid_nicks])
                 self.dispatcher.publish('servers', self.manager, msg)
 
                 content = util.mark(f'Members added: {valid_nicks}', 'GREEN')
                 msg = comm.Message(prefix='INFO', command='MSG', params=[content])
-                self.dispatcher.publish(self.channel, self.manager, msg)
+                self.dispatcher.publish(channel, self.manager, msg)
 
                 for nick in valid_nicks:
-                    content = f'You were added to channel {self.channel}!'
+                    content = f'You were added to channel {channel}!'
 
-                    if self.dispatcher.is_on([nick]):
-                        notification = comm.Message(command='NOTIFIED',
-                                                    params=[self.nick, nick, content])
-                        self.dispatcher.notify(nick, notification)
-                    else:
-                        self.db.add_notification(self.nick, nick, content)
+                    self._notify(nick, content)
             if self.connected:
                 for nick in set(nicks) - set(valid_nicks):
                     self.endpoint.no_user(nick)
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     @defer.inlineCallbacks
     def msg_KICK(self, message):
         _, *nicks = message.params
+        channel = self.channel
 
         try:
-            admin = yield self._get_admin()
-            if admin != self.nick:
+            mode, creator, valid_nicks = yield self.db.kick_members_as(self.nick, channel, nicks)
+            if creator != self.nick:
                 self.endpoint.no_perms('KICK', 'You are not creator of this channel.')
                 return
-        except failure.Failure:
-            self.log_err(f'failed to get admin for {self.channel}')
-            return
+            if mode == 'pub':
+                self.endpoint.bad_operation('kick users from a public channel')
+                return
 
-        try:
-            valid_nicks = yield self.db.users_registered(nicks)
             if valid_nicks:
-                try:
-                    valid_nicks.remove(self.nick)
-                except ValueError:
-                    pass
-
-                yield self.db.delete_members(self.channel, valid_nicks)
                 if self.connected:
-                    self.endpoint.kicked(self.channel, valid_nicks)
+                    self.endpoint.kicked(channel, valid_nicks)
 
-                msg = comm.Message(command='KICKED', params=[self.channel, *valid_nicks])
+                msg = comm.Message(command='KICKED', params=[channel, *valid_nicks])
                 self.dispatcher.publish('servers', self.manager, msg)
 
-                msg = comm.Message(command='KICKED', params=[self.channel, *valid_nicks])
-                self.dispatcher.publish(self.channel, self.manager, msg, locally=True)
+                msg = comm.Message(command='KICKED', params=[channel, *valid_nicks])
+                self.dispatcher.publish(channel, self.manager, msg, locally=True)
 
                 content = util.mark(f'Members kicked: {valid_nicks}', 'RED')
                 msg = comm.Message(prefix='INFO', command='MSG', params=[content])
-                self.dispatcher.publish(self.channel, self.manager, msg)
+                self.dispatcher.publish(channel, self.manager, msg)
 
-                on_channel = self.dispatcher.names(self.channel)
+                on_channel = self.dispatcher.names(channel)
                 for nick in set(valid_nicks) - on_channel:
-                    content = f'You were kicked from channel {self.channel}!'
+                    content = f'You were kicked from channel {channel}!'
 
-                    if self.dispatcher.is_on([nick]):
-                        notification = comm.Message(command='NOTIFIED',
-                                                    params=[self.nick, nick, content])
-                        self.dispatcher.notify(nick, notification)
-                    else:
-                        self.db.add_notification(self.nick, nick, content)
+                    self._notify(nick, content)
             if self.connected:
                 for nick in set(nicks) - set(valid_nicks):
                     self.endpoint.no_user(nick)
-        except failure.Failure:
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     @defer.inlineCallbacks
     def msg_DELETE(self, _):
+        channel = self.channel
+
         try:
-            admin = yield self._get_admin()
-            if admin != self.nick:
+            mode, creator, members = yield self.db.delete_channel_as(self.nick, channel)
+            if creator != self.nick:
                 self.endpoint.no_perms('DELETE', 'You are not creator of this channel.')
                 return
-        except failure.Failure:
-            self.log_err(f'failed to get admin for {self.channel}')
-            return
-
-        try:
-            try:
-                mode = yield self.db.get_channel_mode(self.channel)
-                if mode == 'priv':
-                    content = f'Channel {self.channel} was deleted!'
 
-                    members = yield self.db.get_members(self.channel)
-                    on_channel = self.dispatcher.names(self.channel)
-                    for nick in set(members) - on_channel:
-                        if nick != self.nick:
-                            if self.dispatcher.is_on([nick]):
-                                notification = comm.Message(command='NOTIFIED',
-                                                            params=[self.nick, nick, content])
-                                self.dispatcher.notify(nick, notification)
-                            else:
-                                self.db.add_notification(self.nick, nick, content)
-            except failure.Failure:
-                self.log_err(f'failed to send notifications upon {self.channel} deletion.')
+            if mode == 'priv':
+                content = f'Channel {channel} was deleted!'
 
-            yield self.db.delete_channel(self.channel)
+                on_channel = self.dispatcher.names(channel)
+                for nick in set(members) - on_channel:
+                    if nick != self.nick:
+                        self._notify(nick, content)
 
-            msg = comm.Message(command='OK_DELETED', params=[self.channel])
-            self.dispatcher.publish(self.channel, self.manager, msg, locally=True)
+            msg = comm.Message(command='OK_DELETED', params=[channel])
+            self.dispatcher.publish(channel, self.manager, msg, locally=True)
 
-            self.dispatcher.remove_channel(self.channel)
+            self.dispatcher.remove_channel(channel)
             self.dispatcher.publish('servers', self.manager, msg)
 
             if self.connected:
-                self.endpoint.channel_deleted(self.channel)
-            self.manager.state_logged_in(self.nick, starting=False)
-        except failure.Failure:
+                self.endpoint.channel_deleted(channel)
+            if self.channel == channel:
+                self.manager.state_logged_in(self.nick, starting=False)
+        except DBError:
             self.endpoint.internal_error('DB error, please try again.')
 
     def brd_KICKED(self, message):
@@ -869,9 +852,8 @@ class ConversationState(peer.State):
             self.manager.state_logged_in(self.nick, starting=False)
 
     def brd_MSG(self, message):
-        author = message.prefix
-        content = message.params[-1]
-        self.endpoint.msg(author, self.channel, content)
+        # All receivers are on the same channel, so they share the encoding.
+        self.endpoint.msg_broadcast(message, self.channel)
 
     def brd_OK_DELETED(self, _):
         self.endpoint.channel_deleted(self.channel)
@@ -888,26 +870,23 @@ class ChatClient(peer.Peer):
         self.ai_conn = ai_conn
 
     def state_init(self, message=None):
-        self.state = InitialState(self.protocol, self.endpoint, self)
+        if self.state is None:
+            self.state = ClientState(self.protocol, self.endpoint,
+                                     self.db, self.dispatcher, self.ai_conn, self)
+        self.state.switch(InitialState)
         if message:
             self.state.handle_message(message)
 
     def state_registering(self, message):
-        self.state = RegisteringState(self.protocol, self.endpoint,
-                                      self.db, self.dispatcher, self)
+        self.state.switch(RegisteringState)
         self.state.handle_message(message)
 
     def state_logging_in(self, message):
-        self.state = LoggingInState(self.protocol, self.endpoint,
-                                    self.db, self.dispatcher, self)
+        self.state.switch(LoggingInState)
         self.state.handle_message(message)
 
     def state_logged_in(self, nick, starting=True):
-        self.state = LoggedInState(self.protocol, self.endpoint,
-                                   self.db, self.dispatcher, self,
-                                   nick, starting)
+        self.state.switch(LoggedInState, nick, starting)
 
     def state_conversation(self, nick, channel):
-        self.state = ConversationState(self.protocol, self.endpoint,
-                                       self.db, self.dispatcher, self, self.ai_conn,
-                                       nick, channel)
+        self.state.switch(ConversationState, nick, channel)
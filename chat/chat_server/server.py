@@ -1,11 +1,18 @@
+import signal
+from collections import deque
+
 from twisted.python import log, failure
 from twisted.internet import protocol, defer
 from twisted.application import service
-from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.application.internet import ClientService
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 
 from chat import config
 from chat.chat_server import peer
 from chat.chat_server import dispatch
+from chat.chat_server.instrument import Instrumentation
 from chat import communication as comm
 
 
@@ -36,6 +43,10 @@ class PeerFactory(protocol.Factory):
 
     def buildProtocol(self, addr):
         protocol = self.protocol()
+        protocol.coalesce_writes = config.coalesce_writes
+        protocol.output_max_lines = config.output_max_lines
+        protocol.output_max_bytes = config.output_max_bytes
+        protocol.output_policy = config.slow_consumer_policy
         subscriber = self.InitialSubscriber(self, protocol)
         protocol.register_subscriber(subscriber)
 
@@ -59,19 +70,135 @@ class PeerFactory(protocol.Factory):
         log.err(f'Received {cmd} with params: {params}')
 
 
+@implementer(IPushProducer)
+class AIConnection(comm.BaseProtocol):
+    """
+    Long-lived connection to the AI service, owned by AIConnector.
+
+    It registers itself as a push producer on its own transport, so
+    that the connector learns when the transport's write buffer fills
+    up (AI service never writes back, so there is no reading to pause).
+    """
+
+    def __init__(self, connector):
+        super().__init__()
+        self.connector = connector
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        self.connector.connection_made(self)
+
+    def connectionLost(self, reason):
+        self.connector.connection_lost(self)
+        super().connectionLost(reason)
+
+    def pauseProducing(self):
+        self.connector.connection_paused(self)
+
+    def resumeProducing(self):
+        self.connector.connection_resumed(self)
+
+    def stopProducing(self):
+        pass
+
+
+class AIConnectionFactory(protocol.Factory):
+    def __init__(self, connector):
+        self.connector = connector
+
+    def buildProtocol(self, addr):
+        return AIConnection(self.connector)
+
+
 class AIConnector:
-    def __init__(self):
+    """
+    Pool of persistent, auto-reconnecting connections to the AI service.
+
+    Lines are pipelined round-robin over connections whose transports
+    accept writes. If there are none (not connected yet or all of them
+    are paused), lines wait in a bounded queue and the oldest ones are
+    dropped once it is full.
+    """
+
+    def __init__(self, pool_size=None, max_pending=None):
         from twisted.internet import reactor
         self.ai_endpoint = TCP4ClientEndpoint(reactor, config.ai_server_host,
                                               config.ai_server_port)
+        pool_size = pool_size or config.ai_pool_size
+        self.max_pending = max_pending or config.ai_max_pending
+
+        factory = AIConnectionFactory(self)
+        self._services = [ClientService(self.ai_endpoint, factory) for _ in range(pool_size)]
+        self._writable = deque()
+        self._pending = deque()
+        self._running = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    def start(self):
+        self._running = True
+        for s in self._services:
+            s.startService()
+
+    def stop(self):
+        self._running = False
+        return defer.DeferredList([s.stopService() for s in self._services])
+
+    def stats(self):
+        return {
+            'connected': len(self._writable),
+            'pending': len(self._pending),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'reconnects': self.reconnects,
+        }
 
     def send_msg(self, msg):
-        def gotProtocol(p):
-            p.sendLine(msg)
-            p.loseConnection()
-
-        d = connectProtocol(self.ai_endpoint, comm.BaseProtocol())
-        d.addCallback(gotProtocol)
+        if self._writable and not self._pending:
+            self._write(msg)
+        else:
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(msg)
+            self._flush()
+
+    def _write(self, msg):
+        conn = self._writable[0]
+        self._writable.rotate(-1)
+        conn.sendLine(msg)
+        self.sent += 1
+
+    def _flush(self):
+        while self._pending and self._writable:
+            self._write(self._pending.popleft())
+
+    def connection_made(self, conn):
+        log.msg('AI: connection made')
+        self._writable.append(conn)
+        self._flush()
+
+    def connection_lost(self, conn):
+        self._discard(conn)
+        if self._running:
+            self.reconnects += 1
+            log.msg('AI: connection lost, reconnecting')
+
+    def connection_paused(self, conn):
+        self._discard(conn)
+
+    def connection_resumed(self, conn):
+        if conn not in self._writable:
+            self._writable.append(conn)
+        self._flush()
+
+    def _discard(self, conn):
+        try:
+            self._writable.remove(conn)
+        except ValueError:
+            pass
 
 
 class ChatServer(service.Service):
@@ -81,11 +208,32 @@ class ChatServer(service.Service):
         self.ai_conn = AIConnector()
         self.peer_factory = PeerFactory(self.db, self.dispatcher, self.ai_conn)
 
+        if config.dispatch_instrumentation:
+            self.dispatcher.instrument(Instrumentation('DISPATCH', config.instrumentation_sample_rate))
+        if config.command_instrumentation:
+            peer.State.instrumentation = Instrumentation('COMMAND')
+
     def startService(self):
         from twisted.internet import reactor
+        signal.signal(signal.SIGUSR2, lambda *_: reactor.callFromThread(self.dump_stats))
+        self.ai_conn.start()
         reactor.listenTCP(config.chat_server_port,
                           self.peer_factory,
                           interface=config.chat_server_host)
 
     def stopService(self):
-        pass
+        return self.ai_conn.stop()
+
+    def dump_stats(self):
+        log.msg(f'AI: {self.ai_conn.stats()}')
+        log.msg(f'DB: {self.db.stats()}')
+        self.db.instrumentation.dump()
+
+        for nick, p in self.dispatcher.user2peer.items():
+            stats = p.output_stats()
+            if stats and (stats['paused'] or stats['dropped']):
+                log.msg(f'LAGGING: {nick} {stats}')
+        if self.dispatcher.instrumentation:
+            self.dispatcher.instrumentation.dump()
+        if peer.State.instrumentation:
+            peer.State.instrumentation.dump()
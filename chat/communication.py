@@ -1,9 +1,13 @@
 # Partially based on twisted.words.irc
+import re
 import string
 from abc import ABC, abstractmethod
+from collections import deque
 
+from twisted.internet.interfaces import IPushProducer
 from twisted.protocols import basic
 from twisted.python import log
+from zope.interface import implementer
 
 
 class BadMessage(Exception):
@@ -18,11 +22,23 @@ class Message:
     This class defines what a correct message string looks like - if
     constructor does not raise BadMessage exception, then given
     string is correct.
+
+    Parameters of a parsed message are split only when `params` is
+    first accessed.
     """
 
-    whitespace = set(string.whitespace)
+    __slots__ = ('prefix', 'command', '_params', '_middle', '_trailing', 'encoded')
+
     alpha = set(string.ascii_letters) | set('_')
 
+    # Correct lines only - anything else goes through _parse_message,
+    # which tells what is wrong with it.
+    line_pattern = re.compile(r'(?::(?P<prefix>[^ ]*) )?'
+                              r'\s*(?P<command>[A-Za-z_]+)'
+                              r'(?P<middle>\s[^:]*)?'
+                              r'(?::(?P<trailing>.*))?',
+                              re.DOTALL)
+
     num_par = {
         'REGISTER': 2,
         'ERR_NUM_PARAMS': 0,
@@ -54,17 +70,40 @@ class Message:
     }
 
     def __init__(self, string=None, prefix='', command='', params=None):
-        params = [] if not params else params
-        if string:
-            prefix, command, params = self._parse_message(string)
-
-            correct_num_par = self.num_par.get(command, len(params))
-            if len(params) != correct_num_par:
+        self._params = [] if not params else params
+        self._middle = self._trailing = None
+
+        if string is not None:
+            match = self.line_pattern.fullmatch(string)
+            if match:
+                prefix, command, self._middle, self._trailing = match.groups('')
+                self._params = None
+            else:
+                prefix, command, self._params = self._parse_message(string)
+
+            correct_num_par = self.num_par.get(command, None)
+            if correct_num_par is not None and len(self.params) != correct_num_par:
                 raise BadMessage(f'{command}: bad number of parameters.')
 
         self.prefix = prefix
         self.command = command.upper()
-        self.params = params
+
+        # Wire bytes of a broadcast, built by its first receiver and
+        # shared by all the others.
+        self.encoded = None
+
+    @property
+    def params(self):
+        if self._params is None:
+            params = self._middle.split()
+            if self._trailing:
+                params.append(self._trailing)
+            self._params = params
+        return self._params
+
+    @params.setter
+    def params(self, params):
+        self._params = params
 
     @staticmethod
     def _parse_message(string):
@@ -80,11 +119,13 @@ class Message:
 
         prefix, trailing = '', ''
         if string[0] == ':':
+            if ' ' not in string:
+                raise BadMessage('No command.')
             prefix, string = string[1:].split(' ', 1)
         if ':' in string:
             string, trailing = string.split(':', 1)
 
-        if not string or set(string).issubset(Message.whitespace):
+        if not string or string.isspace():
             raise BadMessage('No command.')
 
         args = string.split()
@@ -129,6 +170,8 @@ class MessageSubscriber(ABC):
     A subscriber to a MessageSource.
     """
 
+    __slots__ = ()
+
     @abstractmethod
     def handle_message(self, message):
         """
@@ -144,6 +187,122 @@ class MessageSubscriber(ABC):
         """
 
 
+@implementer(IPushProducer)
+class OutputBuffer:
+    """
+    Coalesces lines sent within one reactor iteration into a single
+    writeSequence call.
+
+    It is registered as a push producer on the transport, so it holds
+    lines back while the transport's own buffer is full. At most
+    `max_lines` lines and `max_bytes` bytes are held back (None means
+    no limit), beyond that `policy` decides what happens:
+      * 'drop_oldest' - oldest lines are dropped to make room,
+      * 'drop_new' - the new line is dropped,
+      * 'disconnect' - everything is dropped and `on_overflow` is called.
+    """
+
+    policies = ('drop_oldest', 'drop_new', 'disconnect')
+
+    def __init__(self, transport, max_lines=None, max_bytes=None,
+                 policy='disconnect', on_overflow=None, clock=None):
+        if policy not in self.policies:
+            raise ValueError(f'policy must be one of: {", ".join(self.policies)}.')
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.transport = transport
+        self.clock = clock
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_overflow = on_overflow
+
+        self.lines = deque()
+        self.size = 0
+        self.paused = False
+        self.overflowed = False
+        self.dropped = 0
+        self._delayed_flush = None
+
+        transport.registerProducer(self, True)
+
+    def write(self, data):
+        if self.overflowed:
+            return
+
+        if self._too_much(data):
+            if self.policy == 'drop_oldest' and self._fits_alone(data):
+                while self.lines and self._too_much(data):
+                    self.size -= len(self.lines.popleft())
+                    self.dropped += 1
+            elif self.policy == 'disconnect':
+                self.overflowed = True
+                self.dropped += len(self.lines) + 1
+                self._discard()
+                if self.on_overflow:
+                    self.on_overflow()
+                return
+
+            if self._too_much(data):
+                self.dropped += 1
+                return
+
+        self.lines.append(data)
+        self.size += len(data)
+        if not self.paused and self._delayed_flush is None:
+            self._delayed_flush = self.clock.callLater(0, self.flush)
+
+    def _fits_alone(self, data):
+        return self.max_bytes is None or len(data) <= self.max_bytes
+
+    def _too_much(self, data):
+        return ((self.max_lines is not None and len(self.lines) >= self.max_lines) or
+                (self.max_bytes is not None and self.size + len(data) > self.max_bytes))
+
+    def flush(self, force=False):
+        self._cancel_flush()
+
+        if self.lines and (force or not self.paused):
+            lines = list(self.lines)
+            self.lines.clear()
+            self.size = 0
+            self.transport.writeSequence(lines)
+
+    def close(self):
+        self.flush(force=True)
+        self.transport.unregisterProducer()
+
+    def stats(self):
+        return {
+            'paused': self.paused,
+            'lines': len(self.lines),
+            'bytes': self.size,
+            'dropped': self.dropped,
+            'overflowed': self.overflowed,
+        }
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush()
+
+    def stopProducing(self):
+        self._discard()
+
+    def _discard(self):
+        self._cancel_flush()
+        self.lines.clear()
+        self.size = 0
+
+    def _cancel_flush(self):
+        if self._delayed_flush is not None and self._delayed_flush.active():
+            self._delayed_flush.cancel()
+        self._delayed_flush = None
+
+
 class BaseProtocol(basic.LineReceiver, MessageSource):
     """
     Physical connection to someone who communicates using Messages.
@@ -151,9 +310,49 @@ class BaseProtocol(basic.LineReceiver, MessageSource):
     On one hand, it is a source of correct messages. But on the other,
     it also provides sendLine method, that sends lines of text to a
     remote someone.
+
+    With `coalesce_writes` set before the connection is made, lines
+    go through an OutputBuffer (limited by `output_max_lines`,
+    `output_max_bytes` and `output_policy`) instead of straight to the
+    transport. Timers run on `clock`, the reactor unless set.
     """
 
     delimiter = '\n'.encode('utf-8')
+    coalesce_writes = False
+    output_max_lines = None
+    output_max_bytes = None
+    output_policy = 'disconnect'
+    abort_timeout = 10
+    clock = None
+    _output = None
+
+    def connectionMade(self):
+        if self.coalesce_writes:
+            self._output = OutputBuffer(self.transport,
+                                        self.output_max_lines,
+                                        self.output_max_bytes,
+                                        self.output_policy,
+                                        self._output_overflowed,
+                                        self.clock)
+
+    def output_stats(self):
+        return self._output.stats() if self._output else None
+
+    def _output_overflowed(self):
+        log.err('ERR: output buffer overflow, closing connection')
+        self.transport.unregisterProducer()
+        self.transport.write(encode_line('CLOSED :Output buffer overflow.'))
+        self.transport.loseConnection()
+
+        # Remote end may not read at all, so the transport could never drain.
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        clock.callLater(self.abort_timeout, self._abort)
+
+    def _abort(self):
+        if self.transport.connected:
+            self.transport.abortConnection()
 
     def lineReceived(self, line):
         line = line.decode('utf-8', errors='ignore')
@@ -166,9 +365,22 @@ class BaseProtocol(basic.LineReceiver, MessageSource):
 
     def sendLine(self, line):
         line = line.encode('utf-8', errors='ignore')
-        super().sendLine(line)
+        if self._output:
+            self._output.write(line + self.delimiter)
+        else:
+            super().sendLine(line)
+
+    def sendEncodedLine(self, data):
+        """Sends a line already encoded with `encode_line`."""
+        if self._output:
+            self._output.write(data)
+        else:
+            self.transport.write(data)
 
     def loseConnection(self):
+        if self._output:
+            self._output.close()
+            self._output = None
         self.transport.loseConnection()
 
     def connectionLost(self, reason):
@@ -188,3 +400,15 @@ class Endpoint(ABC):
 
     def send(self, line):
         self._protocol.sendLine(line)
+
+    def send_encoded(self, data):
+        self._protocol.sendEncodedLine(data)
+
+    def send_lines(self, lines):
+        """Sends `lines` with a single write."""
+        self._protocol.sendEncodedLine(b''.join(encode_line(line) for line in lines))
+
+
+def encode_line(line):
+    """Encodes a line to bytes ready to be written to a transport."""
+    return line.encode('utf-8', errors='ignore') + BaseProtocol.delimiter
@@ -1,11 +1,70 @@
 db_type = 'sqlite3'
 db_name = 'chat_server.db'
+# SQLite tuning: page cache size is in KiB when negative, mmap_size in
+# bytes. Lock waits are limited to half the shortest DB deadline below.
+# With synchronous NORMAL in WAL mode, the last commits may be lost on a
+# power failure, FULL makes every commit durable at some write cost.
+db_journal_mode = 'WAL'
+db_synchronous = 'NORMAL'
+db_page_cache_size = -16000
+db_mmap_size = 64 * 1024 * 1024
+db_readers = 4
+# Notifications and membership changes are committed in batches of up to
+# db_write_batch_size, at most db_write_batch_delay seconds late.
+db_write_batch_size = 500
+db_write_batch_delay = 0.01
+# Times a batch is retried while the database is locked by another process.
+db_write_lock_retries = 3
+# Deadline of DB operations in seconds, with per-operation overrides,
+# e.g. {'take_notifications': 10.0}.
+db_timeout = 5.0
+db_timeouts = {}
+# Notifications are delivered at login in batches of this size.
+notification_batch_size = 100
+# Passwords are hashed with scrypt, n = 2 ** password_cost, on
+# password_workers threads. Hashing is rejected when password_max_queued
+# jobs wait for a thread, or too many are in progress for one IP address
+# or nick.
+password_cost = 14
+password_workers = 2
+password_max_queued = 64
+password_max_per_ip = 4
+password_max_per_nick = 2
 
 chat_server_host = 'localhost'
 chat_server_port = 8080
 server_password = 'VERY_SECRET_PASSWORD'
 
+# Coalesce lines sent to a client within one reactor iteration and limit
+# how much is held back for a slow client. Policy is one of: drop_oldest,
+# drop_new, disconnect.
+coalesce_writes = True
+output_max_lines = 10000
+output_max_bytes = 1024 * 1024
+slow_consumer_policy = 'disconnect'
+
+# Timing of dispatcher operations and client commands, dumped to the log
+# on SIGUSR2.
+dispatch_instrumentation = False
+command_instrumentation = False
+instrumentation_sample_rate = 0.0
+
 ai_server_host = 'localhost'
 ai_server_port = 8081
+ai_pool_size = 2
+ai_max_pending = 1000
+ai_batch_size = 32
+ai_batch_delay = 0.01
+ai_workers = 1
+ai_max_queued = 64
+ai_overload_policy = 'drop'
 
 flask_host = 'http://127.0.0.1:5000/'
+flask_ingest_url = flask_host + 'ingest'
+monitor_flush_size = 100
+monitor_flush_interval = 1.0
+monitor_max_spill = 10000
+# Seconds before a post to the monitor fails, and for which the buffer
+# is still posted on shutdown.
+monitor_post_timeout = 10.0
+monitor_stop_timeout = 10.0
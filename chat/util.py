@@ -1,4 +1,9 @@
 import datetime
+from collections import deque
+
+from twisted.internet import defer, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 
 
 def get_time():
@@ -19,3 +24,98 @@ def mark(msg, color):
     #     return colors[color] + msg + ENDC
     # return colors['WHITE'] + msg + ENDC
     return msg  # PyQt5 quick fix
+
+
+class Overloaded(Exception):
+    """Worker queue is full, the work was not accepted."""
+    pass
+
+
+class WorkerPool:
+    """
+    Runs calls on a pool of worker threads, so that the reactor thread
+    is not blocked by them.
+
+    At most `max_queued` calls wait for a free worker. When the queue is
+    full, `policy` decides what happens:
+      * 'drop' - the new call fails with Overloaded,
+      * 'shed' - the oldest waiting call fails with Overloaded,
+        the new one is queued,
+      * 'queue' - the new call is queued anyway.
+
+    Cancelling a waiting call removes it from the queue.
+    """
+
+    policies = ('drop', 'shed', 'queue')
+
+    def __init__(self, workers, max_queued, policy='drop', name='workers'):
+        if policy not in self.policies:
+            raise ValueError(f'policy must be one of: {", ".join(self.policies)}.')
+
+        self.workers = workers
+        self.max_queued = max_queued
+        self.policy = policy
+        self.name = name
+        self.threadpool = ThreadPool(minthreads=workers, maxthreads=workers, name=name)
+
+        self._waiting = deque()
+        self._running = 0
+        self.dropped = 0
+
+    def start(self):
+        self.threadpool.start()
+
+    def stop(self):
+        waiting, self._waiting = self._waiting, deque()
+        for *_, d in waiting:
+            d.errback(Overloaded(f'{self.name} pool stopped.'))
+        self.threadpool.stop()
+
+    def stats(self):
+        return {
+            'waiting': len(self._waiting),
+            'running': self._running,
+            'dropped': self.dropped,
+        }
+
+    def submit(self, func, *args):
+        if len(self._waiting) >= self.max_queued:
+            if self.policy == 'drop':
+                self.dropped += 1
+                return defer.fail(Overloaded(f'{self.name} queue is full.'))
+            elif self.policy == 'shed':
+                self.dropped += 1
+                *_, oldest = self._waiting.popleft()
+                oldest.errback(Overloaded(f'Shed from {self.name} queue.'))
+
+        def cancel(_):
+            if call in self._waiting:
+                self._waiting.remove(call)
+
+        d = defer.Deferred(cancel)
+        call = func, args, d
+        self._waiting.append(call)
+        self._run_next()
+        return d
+
+    def _run_next(self):
+        from twisted.internet import reactor
+
+        while self._waiting and self._running < self.workers:
+            func, args, d = self._waiting.popleft()
+            self._running += 1
+
+            work = threads.deferToThreadPool(reactor, self.threadpool, func, *args)
+            work.addBoth(self._on_done, d)
+
+    def _on_done(self, result, d):
+        self._running -= 1
+        self._run_next()
+
+        if d.called:
+            # Cancelled while running.
+            return
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
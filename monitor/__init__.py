@@ -6,6 +6,10 @@ app = Flask(__name__)
 
 app.config.update(dict(
     DATABASE=os.path.join(app.root_path, 'flask.db'),
+    PAGE_SIZE=100,
+    LIVE_SIZE=40,
+    LIVE_KEEPALIVE=15,
+    STATS_PERIOD=300,
 ))
 
 import monitor.monitor
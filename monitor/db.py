@@ -4,26 +4,79 @@ from flask import g
 from monitor import app
 
 
+# Each entry upgrades the schema by one version, the version is kept in
+# user_version. Databases created by the first initdb are at version 0
+# and already hold the message table.
+migrations = [
+    [
+        'CREATE TABLE IF NOT EXISTS message ('
+        'author TEXT NOT NULL,'
+        'channel TEXT NOT NULL,'
+        'content TEXT NOT NULL,'
+        'score1 REAL NOT NULL,'
+        'score2 REAL NOT NULL,'
+        'score3 REAL NOT NULL,'
+        'score4 REAL NOT NULL,'
+        'score5 REAL NOT NULL,'
+        'score6 REAL NOT NULL);',
+        'CREATE INDEX IF NOT EXISTS message_channel '
+        'ON message (channel);',
+        'CREATE TABLE IF NOT EXISTS channel ('
+        'name TEXT PRIMARY KEY) WITHOUT ROWID;',
+        'INSERT OR IGNORE INTO channel '
+        'SELECT DISTINCT channel FROM message;',
+        'CREATE TABLE IF NOT EXISTS message_stats ('
+        'period INTEGER NOT NULL,'
+        'channel TEXT NOT NULL,'
+        'author TEXT NOT NULL,'
+        'count INTEGER NOT NULL,'
+        'sum1 REAL NOT NULL,'
+        'sum2 REAL NOT NULL,'
+        'sum3 REAL NOT NULL,'
+        'sum4 REAL NOT NULL,'
+        'sum5 REAL NOT NULL,'
+        'sum6 REAL NOT NULL,'
+        'PRIMARY KEY (period, channel, author)) WITHOUT ROWID;',
+    ],
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Brings the schema up to date, if another process has not yet."""
+    if schema_version(conn) >= len(migrations):
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = schema_version(conn)
+        for statements in migrations[version:]:
+            for statement in statements:
+                conn.execute(statement)
+        conn.execute(f'PRAGMA user_version = {len(migrations)}')
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
 def connect_db():
     """Connects to the specific database."""
     conn = sqlite3.connect(app.config['DATABASE'])
+    # WAL lets page views read while ingest writes, and with it
+    # synchronous=NORMAL syncs on checkpoints rather than on every commit.
+    conn.execute('PRAGMA journal_mode = WAL;')
+    conn.execute('PRAGMA synchronous = NORMAL;')
+    migrate(conn)
     return conn
 
 
 def init_db():
     """Initializes the database."""
-    db = get_db()
-    db.cursor().execute('CREATE TABLE IF NOT EXISTS message ('
-                        'author TEXT NOT NULL,'
-                        'channel TEXT NOT NULL,'
-                        'content TEXT NOT NULL,'
-                        'score1 REAL NOT NULL,'
-                        'score2 REAL NOT NULL,'
-                        'score3 REAL NOT NULL,'
-                        'score4 REAL NOT NULL,'
-                        'score5 REAL NOT NULL,'
-                        'score6 REAL NOT NULL);')
-    db.commit()
+    migrate(get_db())
 
 
 @app.cli.command('initdb')
@@ -1,110 +1,231 @@
-from flask import request, render_template, g
+from flask import request, render_template, Response, jsonify, g
+from collections import deque
 import json
+import re
+import sqlite3
+import threading
+import time
 
 from monitor import app, db
 
-live_list = []
-channels_list = []
 
+class LiveFeed:
+    """
+    Fixed-size buffer of the most recently scored messages.
+
+    Every entry gets an increasing id, so that streaming clients can
+    wait for entries newer than the last one they have seen.
+    """
+
+    def __init__(self, size):
+        self._entries = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self.last_id = 0
+
+    def extend(self, lines):
+        with self._cond:
+            for line in lines:
+                self.last_id += 1
+                self._entries.append((self.last_id, line))
+            self._cond.notify_all()
+
+    def lines(self):
+        with self._cond:
+            return [line for _, line in self._entries]
+
+    def since(self, last_id, timeout):
+        """
+        Returns entries newer than `last_id`, waits up to `timeout` seconds
+        for them. An id this feed has not reached yet was given out before
+        a restart, so all buffered entries are newer than it.
+        """
+        with self._cond:
+            if last_id > self.last_id:
+                last_id = 0
+            self._cond.wait_for(lambda: self.last_id > last_id, timeout)
+            return [(i, line) for i, line in self._entries if i > last_id]
+
+
+live_feed = LiveFeed(app.config['LIVE_SIZE'])
+
+
+# maps a score column to intensity bucket 0-3
+def bucket(column):
+    return (f'CASE WHEN {column} < 0.5 THEN 0 '
+            f'WHEN {column} < 0.65 THEN 1 '
+            f'WHEN {column} < 0.80 THEN 2 '
+            f'ELSE 3 END')
+
+
+select_page = ('SELECT rowid, author, content, {} '
+               'FROM message '
+               .format(', '.join(bucket(f'score{i}') for i in range(1, 7))))
+
+
+# fetches a page of messages older than `before` (a rowid), oldest first;
+# returns messages, bucketed ratings and rowid to fetch the previous page with
+def fetch_page(channel_name=None, before=None):
+    limit = app.config['PAGE_SIZE']
+    conditions, params = [], []
+    if channel_name:
+        conditions.append('channel = ?')
+        params.append(channel_name)
+    if before:
+        conditions.append('rowid < ?')
+        params.append(before)
+
+    where = 'WHERE ' + ' AND '.join(conditions) + ' ' if conditions else ''
+    cur = db.get_db().execute(select_page + where + 'ORDER BY rowid DESC LIMIT ?', (*params, limit))
+    rows = cur.fetchall()
+    rows.reverse()
+
+    messages = [author + "> " + content for _, author, content, *_ in rows]
+    ratings_list = [list(row[3:]) for row in rows]
+    older = rows[0][0] if len(rows) == limit else None
+    return messages, ratings_list, older
+
+
+upsert_stats = ('INSERT INTO message_stats VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (period, channel, author) DO UPDATE SET '
+                'count = count + excluded.count, {}'
+                .format(', '.join(f'sum{i} = sum{i} + excluded.sum{i}' for i in range(1, 7))))
+
+select_stats = ('SELECT {key}, SUM(count), {sums} '
+                'FROM message_stats '
+                'WHERE period >= ? '
+                'GROUP BY {key} '
+                'ORDER BY SUM(sum{score}) / SUM(count) DESC '
+                'LIMIT ?')
+
+
+# returns id of the rollup period that timestamp falls into
+def stats_period(timestamp):
+    return int(timestamp) // app.config['STATS_PERIOD']
+
+
+# adds counts and score sums of inserted rows to the current rollup period
+def update_stats(conn, rows):
+    totals = {}
+    for author, channel_name, _, *scores in rows:
+        total = totals.setdefault((channel_name, author), [0] + [0.0] * 6)
+        total[0] += 1
+        for i, score in enumerate(scores, 1):
+            total[i] += score
 
-# extracts all messages from records and returns a list
-def extract_messages(rows):
-    return [r[0] + "> " + r[2] for r in rows]
+    period = stats_period(time.time())
+    conn.executemany(upsert_stats, [(period, channel_name, author, *total)
+                                    for (channel_name, author), total in totals.items()])
 
 
-# extracts all ratings from records and returns list of tuples
-def extract_ratings(rows):
-    return [list(row[3:]) for row in rows]
+# returns names of all channels seen so far, without the leading '#'
+def get_channels():
+    cur = db.get_db().execute('SELECT name FROM channel')
+    return [row[0][1:] for row in cur.fetchall()]
 
 
-# extracts all channels from records and returns list
-def extract_channels(rows):
-    return list(set([row[1] for row in rows]))
+# parses a JSON object, a JSON array or NDJSON and returns list of records
+def parse_records(data):
+    text = data.decode('utf-8', errors='ignore')
+    try:
+        parsed = json.loads(text)
+        return parsed if isinstance(parsed, list) else [parsed]
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+# inserts records within a single transaction
+def insert_records(records):
+    rows = [(r['author'], r['channel'], r['content'], *r['scores'][:6]) for r in records]
+    conn = db.get_db()
+    with conn:
+        conn.executemany('INSERT INTO message VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.executemany('INSERT OR IGNORE INTO channel VALUES(?)', {(r[1],) for r in rows})
+        update_stats(conn, rows)
+
+    live_feed.extend(author + "> " + message for author, _, message, *_ in rows)
+
+
+@app.route('/ingest', methods=['POST'])
+def ingest():
+    try:
+        records = parse_records(request.get_data())
+        insert_records(records)
+    except (ValueError, KeyError, TypeError, sqlite3.Error):
+        return 'Malformed records.', 400
+
+    return '', 204
 
 
 @app.route('/', methods=['GET', 'POST'])
 def main_page():
-    global channels_list
-    global live_list
-
     if request.method == 'POST':
-        data = json.loads(request.data)
-        author = data['author']
-        channel_name = data['channel']
-        message = data['content']
-        scores = data['scores']
+        return ingest()
+    else:
+        return render_template("main_page.html", messages=live_feed.lines(),
+                               last_id=live_feed.last_id, channels=get_channels(),
+                               live_size=app.config['LIVE_SIZE'])
 
-        params = (author, channel_name, message, *scores[:6])
-        conn = db.get_db()
-        conn.execute('INSERT INTO message VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)', params)
-        conn.commit()
 
-        live_list.append(author + "> " + message)
+# returns channels or authors with the highest mean of given score over
+# the last `since` seconds, e.g. /stats?by=author&since=3600&score=1
+@app.route('/stats')
+def stats():
+    key = request.args.get('by', 'channel')
+    since = request.args.get('since', 3600, type=int)
+    score = request.args.get('score', 1, type=int)
+    limit = request.args.get('limit', 10, type=int)
 
-        if len(live_list) == 40:
-            live_list = live_list[1:]
+    if key not in ('channel', 'author') or score not in range(1, 7):
+        return 'Bad stats query.', 400
+
+    query = select_stats.format(key=key, score=score,
+                                sums=', '.join(f'SUM(sum{i})' for i in range(1, 7)))
+    cur = db.get_db().execute(query, (stats_period(time.time() - since), limit))
+
+    return jsonify([{key: name, 'count': count, 'means': [s / count for s in sums]}
+                    for name, count, *sums in cur.fetchall()])
+
+
+# a line break in content would end the event's data field early
+def sse_data(line):
+    return ''.join(f'data: {part}\n' for part in re.split(r'\r\n|\r|\n', line))
 
-        return '', 204
-    else:
-        conn = db.get_db()
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM message')
-        rows = cur.fetchall()
 
-        channels_list = extract_channels(rows)
-        channels_list = [name[1:] for name in channels_list]
-        return render_template("main_page.html", messages=live_list, channels=channels_list)
+# streams newly scored messages as Server-Sent Events
+@app.route('/live')
+def live():
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('after', live_feed.last_id, type=int)
+
+    def stream(last_id):
+        while True:
+            entries = live_feed.since(last_id, app.config['LIVE_KEEPALIVE'])
+            if not entries:
+                yield ': keep-alive\n\n'
+            for last_id, line in entries:
+                yield f'id: {last_id}\n{sse_data(line)}\n'
+
+    return Response(stream(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 # stats: 2D ARRAY [[toxic, severeToxic, ...], [toxic, severeToxic, ...]]
 # messages: regular Array of messages processed from db
 @app.route('/history')
 def history():
-    conn = db.get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM message')
-    rows = cur.fetchall()
+    before = request.args.get('before', type=int)
+    messages, ratings_list, older = fetch_page(before=before)
 
-    messages = extract_messages(rows)
-    ratings_list = extract_ratings(rows)
-    channels_list = extract_channels(rows)
-
-    for i in range(0, len(ratings_list)):
-        for j in range(0, 6):
-
-            if ratings_list[i][j] < 0.5:
-                ratings_list[i][j] = 0
-            elif ratings_list[i][j] < 0.65:
-                ratings_list[i][j] = 1
-            elif ratings_list[i][j] < 0.80:
-                ratings_list[i][j] = 2
-            else:
-                ratings_list[i][j] = 3
-
-    return render_template("history.html", stats=ratings_list, messages=messages, channels=channels_list)
+    return render_template("history.html", stats=ratings_list, messages=messages,
+                           channels=get_channels(), older=older)
 
 
 @app.route('/channel/<name>')
 def channel(name):
-    conn = db.get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM message WHERE channel = ?', ('#' + name,))
-    rows = cur.fetchall()
-
-    messages = extract_messages(rows)
-    ratings_list = extract_ratings(rows)
+    before = request.args.get('before', type=int)
+    messages, ratings_list, older = fetch_page('#' + name, before)
     channels_list = [name]
 
-    for i in range(0, len(ratings_list)):
-        for j in range(0, 6):
-
-            if ratings_list[i][j] < 0.5:
-                ratings_list[i][j] = 0
-            elif ratings_list[i][j] < 0.65:
-                ratings_list[i][j] = 1
-            elif ratings_list[i][j] < 0.80:
-                ratings_list[i][j] = 2
-            else:
-                ratings_list[i][j] = 3
-
-    return render_template("channel.html", stats=ratings_list, messages=messages, channels=channels_list, name=name)
+    return render_template("channel.html", stats=ratings_list, messages=messages,
+                           channels=channels_list, name=name, older=older)
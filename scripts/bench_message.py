@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of Message parsing.
+
+Compares lines per second of the current parser with the one it
+replaced, on a corpus shaped like chat server traffic (mostly MSG
+lines, some commands, a few malformed lines).
+
+Usage: python scripts/bench_message.py [number_of_lines]
+"""
+import random
+import string
+import sys
+import timeit
+
+from chat import communication as comm
+
+
+class LegacyMessage:
+    """Parser as it was before the regex fast path, kept for comparison."""
+
+    whitespace = set(string.whitespace)
+    alpha = set(string.ascii_letters) | set('_')
+
+    def __init__(self, string=None, prefix='', command='', params=None):
+        params = [] if not params else params
+        if string:
+            prefix, command, params = self._parse_message(string)
+
+            correct_num_par = comm.Message.num_par.get(command, len(params))
+            if len(params) != correct_num_par:
+                raise comm.BadMessage(f'{command}: bad number of parameters.')
+
+        self.prefix = prefix
+        self.command = command.upper()
+        self.params = params
+
+    @staticmethod
+    def _parse_message(string):
+        if not string:
+            raise comm.BadMessage('Empty string.')
+
+        prefix, trailing = '', ''
+        if string[0] == ':':
+            prefix, string = string[1:].split(' ', 1)
+        if ':' in string:
+            string, trailing = string.split(':', 1)
+
+        if not string or set(string).issubset(LegacyMessage.whitespace):
+            raise comm.BadMessage('No command.')
+
+        args = string.split()
+        if trailing:
+            args.append(trailing)
+
+        if not set(args[0]).issubset(LegacyMessage.alpha):
+            raise comm.BadMessage('Bad command.')
+
+        return prefix, args[0], args[1:]
+
+
+def make_corpus(size, seed=0):
+    rng = random.Random(seed)
+    words = ['hello', 'there', 'what', 'is', 'going', 'on', 'lol', 'ok', 'see', 'you',
+             'tomorrow', 'at', 'the', 'meeting', 'zażółć', 'gęślą', 'jaźń', ':)']
+    nicks = [f'user{i}' for i in range(50)]
+    channels = [f'#channel{i}' for i in range(10)]
+
+    def text():
+        return ' '.join(rng.choice(words) for _ in range(rng.randint(1, 25)))
+
+    templates = [
+        (70, lambda: f'MSG {rng.choice(channels)} :{text()}'),
+        (10, lambda: f':{rng.choice(nicks)} MSG {rng.choice(channels)} :{text()}'),
+        (4, lambda: f'JOIN {rng.choice(channels)}'),
+        (3, lambda: 'LIST'),
+        (3, lambda: f'ISON {" ".join(rng.sample(nicks, 5))}'),
+        (3, lambda: f'LOGIN {rng.choice(nicks)}'),
+        (3, lambda: f'PASSWORD {rng.choice(words)}'),
+        (2, lambda: f'NOTIFIED {rng.choice(nicks)} :{text()}'),
+        (2, lambda: f'MSG#bad :{text()}'),
+    ]
+    weights = [w for w, _ in templates]
+    makers = [m for _, m in templates]
+
+    return [rng.choices(makers, weights)[0]() for _ in range(size)]
+
+
+def parse_all(cls, corpus):
+    for line in corpus:
+        try:
+            message = cls(line)
+            message.params
+        except comm.BadMessage:
+            pass
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    corpus = make_corpus(size)
+
+    for name, cls in (('before', LegacyMessage), ('after', comm.Message)):
+        best = min(timeit.repeat(lambda: parse_all(cls, corpus), number=1, repeat=5))
+        print(f'{name:>6}: {size / best:12,.0f} lines/s')
+
+
+if __name__ == '__main__':
+    main()
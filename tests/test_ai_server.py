@@ -0,0 +1,189 @@
+import json
+
+import pytest
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+pytest.importorskip('keras')
+
+from chat.ai_server.server import MicroBatcher, MonitorExporter
+
+
+class Recorder:
+    def __init__(self, result=None):
+        self.batches = []
+        self.result = result
+
+    def __call__(self, items):
+        self.batches.append(items)
+        if self.result is not None:
+            return self.result
+        return [item * 2 for item in items]
+
+
+def results_of(deferreds):
+    results = []
+    for d in deferreds:
+        d.addBoth(results.append)
+    return results
+
+
+def test_micro_batcher_processes_full_batch_at_once():
+    process, clock = Recorder(), task.Clock()
+    batcher = MicroBatcher(process, max_size=2, max_delay=1, clock=clock)
+
+    results = results_of([batcher.submit(1), batcher.submit(2)])
+
+    assert process.batches == [[1, 2]]
+    assert results == [2, 4]
+    assert not clock.getDelayedCalls()
+
+
+def test_micro_batcher_processes_partial_batch_after_delay():
+    process, clock = Recorder(), task.Clock()
+    batcher = MicroBatcher(process, max_size=3, max_delay=1, clock=clock)
+
+    results = results_of([batcher.submit(1), batcher.submit(2)])
+    clock.advance(0.5)
+    assert process.batches == []
+
+    clock.advance(0.5)
+    assert process.batches == [[1, 2]]
+    assert results == [2, 4]
+
+
+def test_micro_batcher_starts_new_delay_after_flush():
+    process, clock = Recorder(), task.Clock()
+    batcher = MicroBatcher(process, max_size=2, max_delay=1, clock=clock)
+
+    batcher.submit(1)
+    batcher.submit(2)
+    batcher.submit(3)
+    clock.advance(1)
+
+    assert process.batches == [[1, 2], [3]]
+
+
+def test_micro_batcher_fails_every_item_of_failed_batch():
+    process = Recorder(result=defer.fail(ValueError('model')))
+    batcher = MicroBatcher(process, max_size=2, max_delay=1, clock=task.Clock())
+
+    results = results_of([batcher.submit(1), batcher.submit(2)])
+
+    assert [r.check(ValueError) for r in results] == [ValueError, ValueError]
+
+
+def test_micro_batcher_flush_waits_for_batches_in_flight():
+    pending = defer.Deferred()
+    batcher = MicroBatcher(Recorder(result=pending), max_size=10, max_delay=1,
+                           clock=task.Clock())
+    results = results_of([batcher.submit(1)])
+
+    flushed = batcher.flush()
+    assert not flushed.called
+
+    pending.callback(['scored'])
+    assert flushed.called
+    assert results == ['scored']
+
+
+class FakeResponse:
+    phrase = b''
+
+    def __init__(self, code):
+        self.code = code
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(b'')
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class FakeAgent:
+    def __init__(self):
+        self.posts = []
+
+    def request(self, method, url, headers, producer):
+        d = defer.Deferred()
+        self.posts.append((json.loads(producer.body), d))
+        return d
+
+    def respond(self, code):
+        _, d = self.posts[-1]
+        d.callback(FakeResponse(code))
+
+
+def make_exporter(**kwargs):
+    settings = dict(flush_size=2, flush_interval=5, max_spill=10, post_timeout=10,
+                    stop_timeout=10, clock=task.Clock())
+    settings.update(kwargs)
+    exporter = MonitorExporter('http://monitor/ingest', **settings)
+    exporter.agent = FakeAgent()
+    return exporter
+
+
+def test_exporter_posts_full_batch_as_array():
+    exporter = make_exporter()
+
+    exporter.export({'n': 1})
+    assert exporter.agent.posts == []
+    exporter.export({'n': 2})
+
+    [(body, _)] = exporter.agent.posts
+    assert body == [{'n': 1}, {'n': 2}]
+    exporter.agent.respond(204)
+    assert exporter.sent == 2
+
+
+def test_exporter_retries_failed_batch_first():
+    exporter = make_exporter()
+
+    exporter.export(1)
+    exporter.export(2)
+    exporter.export(3)
+    exporter.agent.respond(500)
+    assert exporter.sent == 0
+
+    exporter.flush()
+    assert exporter.agent.posts[-1][0] == [1, 2]
+    exporter.agent.respond(200)
+    assert exporter.sent == 2
+    assert list(exporter._buffer) == [3]
+
+
+def test_exporter_retries_timed_out_post():
+    exporter = make_exporter(post_timeout=3)
+
+    exporter.export(1)
+    exporter.export(2)
+    exporter.clock.advance(3)
+
+    assert exporter.sent == 0
+    assert list(exporter._buffer) == [1, 2]
+
+
+def test_exporter_drops_oldest_records_beyond_spill():
+    exporter = make_exporter(max_spill=3)
+
+    exporter.export(1)
+    exporter.export(2)
+    for record in [3, 4, 5]:
+        exporter.export(record)
+    assert len(exporter.agent.posts) == 1
+
+    exporter.agent.respond(503)
+    assert list(exporter._buffer) == [3, 4, 5]
+    assert exporter.dropped == 2
+
+
+def test_exporter_stop_cancels_post_at_stop_timeout():
+    exporter = make_exporter(stop_timeout=1)
+    exporter.export(1)
+    exporter.export(2)
+
+    stopped = exporter.stop()
+    assert not stopped.called
+
+    exporter.clock.advance(1)
+    assert stopped.called
+    assert list(exporter._buffer) == [1, 2]
@@ -0,0 +1,58 @@
+from twisted.internet import defer
+from twisted.internet.testing import StringTransport
+
+from chat import communication as comm
+from chat.chat_server.dispatch import Dispatcher
+from chat.chat_server.peer import ChatClient
+from chat.chat_server.peer.chat_client import ChatClientEndpoint
+
+
+class FakeDB:
+    def __init__(self, modes, members):
+        self.modes = modes
+        self.members = set(members)
+
+    def get_channel_mode(self, channel):
+        return defer.succeed(self.modes.get(channel))
+
+    def is_member(self, nick, channel):
+        return defer.succeed((nick, channel) in self.members)
+
+    def delete_members(self, channel, nicks):
+        self.members -= {(nick, channel) for nick in nicks}
+        return defer.succeed(None)
+
+    def take_notifications(self, user, limit):
+        return defer.succeed([])
+
+
+def logged_in_client(db, nick):
+    protocol = comm.BaseProtocol()
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+
+    client = ChatClient(db, Dispatcher(['#priv']), None, protocol, ChatClientEndpoint(protocol))
+    client.state_init()
+    client.state_logged_in(nick)
+    transport.clear()
+    return client, transport
+
+
+def test_quit_private_channel():
+    db = FakeDB({'#priv': 'priv'}, [('alice', '#priv')])
+    client, transport = logged_in_client(db, 'alice')
+
+    client.state.handle_message(comm.Message('QUIT #priv'))
+
+    assert transport.value() == b'OK_QUIT #priv alice\n'
+    assert not db.members
+
+
+def test_quit_private_channel_not_member_of():
+    db = FakeDB({'#priv': 'priv'}, [('bob', '#priv')])
+    client, transport = logged_in_client(db, 'alice')
+
+    client.state.handle_message(comm.Message('QUIT #priv'))
+
+    assert transport.value() == b'ERR_NOT_MEMBER alice #priv\n'
+    assert db.members == {('bob', '#priv')}
@@ -0,0 +1,78 @@
+from chat.chat_server.server import AIConnector
+
+
+class FakeConnection:
+    def __init__(self):
+        self.lines = []
+
+    def sendLine(self, line):
+        self.lines.append(line)
+
+
+def make_connector(max_pending=3):
+    connector = AIConnector(pool_size=2, max_pending=max_pending)
+    # Connections are made by the tests, not by client services.
+    connector._services = []
+    connector.start()
+    return connector
+
+
+def test_lines_are_sent_round_robin():
+    connector = make_connector()
+    a, b = FakeConnection(), FakeConnection()
+    connector.connection_made(a)
+    connector.connection_made(b)
+
+    for line in ['1', '2', '3']:
+        connector.send_msg(line)
+
+    assert a.lines == ['1', '3']
+    assert b.lines == ['2']
+    assert connector.stats()['sent'] == 3
+
+
+def test_lines_wait_for_connection_and_oldest_are_dropped():
+    connector = make_connector(max_pending=2)
+
+    for line in ['1', '2', '3']:
+        connector.send_msg(line)
+    assert connector.stats()['pending'] == 2
+    assert connector.stats()['dropped'] == 1
+
+    conn = FakeConnection()
+    connector.connection_made(conn)
+
+    assert conn.lines == ['2', '3']
+    assert connector.stats()['pending'] == 0
+
+
+def test_paused_connections_are_skipped_until_resumed():
+    connector = make_connector()
+    a, b = FakeConnection(), FakeConnection()
+    connector.connection_made(a)
+    connector.connection_made(b)
+
+    connector.connection_paused(a)
+    connector.send_msg('1')
+    connector.send_msg('2')
+    connector.connection_paused(b)
+    connector.send_msg('3')
+    connector.connection_resumed(a)
+
+    assert a.lines == ['3']
+    assert b.lines == ['1', '2']
+
+
+def test_lost_connections_are_counted_as_reconnects_while_running():
+    connector = make_connector()
+    conn = FakeConnection()
+    connector.connection_made(conn)
+
+    connector.connection_lost(conn)
+    connector.send_msg('1')
+    assert connector.stats() == {'connected': 0, 'pending': 1, 'sent': 0,
+                                 'dropped': 0, 'reconnects': 1}
+
+    connector.stop()
+    connector.connection_lost(conn)
+    assert connector.stats()['reconnects'] == 1
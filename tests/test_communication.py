@@ -0,0 +1,125 @@
+import pytest
+from twisted.internet import task
+from twisted.internet.testing import StringTransport
+
+import chat.communication as comm
+
+
+def make_buffer(**kwargs):
+    transport = StringTransport()
+    clock = task.Clock()
+    return comm.OutputBuffer(transport, clock=clock, **kwargs), transport, clock
+
+
+def test_output_buffer_coalesces_lines_until_next_iteration():
+    output, transport, clock = make_buffer()
+
+    output.write(b'a\n')
+    output.write(b'b\n')
+    assert transport.value() == b''
+
+    clock.advance(0)
+    assert transport.value() == b'a\nb\n'
+    assert transport.producer is output
+
+
+def test_output_buffer_holds_lines_while_paused():
+    output, transport, clock = make_buffer()
+
+    output.pauseProducing()
+    output.write(b'a\n')
+    clock.advance(0)
+    assert transport.value() == b''
+    assert output.stats()['lines'] == 1
+
+    output.resumeProducing()
+    assert transport.value() == b'a\n'
+    assert output.stats()['lines'] == 0
+
+
+@pytest.mark.parametrize('limits, kept', [
+    ({'max_lines': 2}, b'b\nc\n'),
+    ({'max_bytes': 5}, b'b\nc\n'),
+])
+def test_output_buffer_drop_oldest(limits, kept):
+    output, transport, _ = make_buffer(policy='drop_oldest', **limits)
+
+    output.pauseProducing()
+    for line in [b'a\n', b'b\n', b'c\n']:
+        output.write(line)
+    output.resumeProducing()
+
+    assert transport.value() == kept
+    assert output.stats()['dropped'] == 1
+
+
+@pytest.mark.parametrize('limits, kept', [
+    ({'max_lines': 2}, b'a\nb\n'),
+    ({'max_bytes': 5}, b'a\nb\n'),
+])
+def test_output_buffer_drop_new(limits, kept):
+    output, transport, _ = make_buffer(policy='drop_new', **limits)
+
+    output.pauseProducing()
+    for line in [b'a\n', b'b\n', b'c\n']:
+        output.write(line)
+    output.resumeProducing()
+
+    assert transport.value() == kept
+    assert output.stats()['dropped'] == 1
+
+
+def test_output_buffer_drops_line_larger_than_limit():
+    output, transport, clock = make_buffer(policy='drop_oldest', max_bytes=3)
+
+    output.write(b'a\n')
+    output.write(b'too long\n')
+    clock.advance(0)
+
+    assert transport.value() == b'a\n'
+    assert output.stats()['dropped'] == 1
+
+
+def make_protocol(**attrs):
+    protocol = comm.BaseProtocol()
+    protocol.coalesce_writes = True
+    protocol.clock = task.Clock()
+    for name, value in attrs.items():
+        setattr(protocol, name, value)
+
+    transport = StringTransport()
+    transport.connected = True
+    protocol.makeConnection(transport)
+    return protocol, transport
+
+
+def test_overflow_disconnects_and_aborts_after_timeout():
+    protocol, transport = make_protocol(output_max_lines=1, output_policy='disconnect',
+                                        abort_timeout=10)
+
+    transport.producer.pauseProducing()
+    protocol.sendLine('a')
+    protocol.sendLine('b')
+    protocol.sendLine('c')
+
+    assert transport.value() == b'CLOSED :Output buffer overflow.\n'
+    assert transport.disconnecting
+    assert transport.producer is None
+    assert protocol.output_stats()['overflowed']
+    assert protocol.output_stats()['dropped'] == 2
+
+    protocol.clock.advance(9)
+    assert not transport.disconnected
+    protocol.clock.advance(1)
+    assert transport.disconnected
+
+
+def test_overflow_does_not_abort_closed_connection():
+    protocol, transport = make_protocol(output_max_bytes=1, output_policy='disconnect')
+
+    protocol.sendLine('too long')
+    transport.connected = False
+    protocol.clock.advance(protocol.abort_timeout)
+
+    assert transport.disconnecting
+    assert not transport.disconnected
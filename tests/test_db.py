@@ -0,0 +1,277 @@
+import sqlite3
+
+import pytest
+from twisted.internet import defer, task
+
+from chat.chat_server.db import DBService, query
+from chat.chat_server.db.batch import WriteBehind
+from chat.chat_server.db.directory import Directory
+from chat.chat_server.db.password import PasswordHasher, check_password, hash_password
+from chat.util import Overloaded
+
+
+select_notifications = 'SELECT author, content FROM notification WHERE target = ?'
+
+
+def create_schema(con):
+    DBService._create_tables(con.cursor())
+    con.commit()
+
+
+def test_migrations_set_version_and_are_idempotent():
+    con = sqlite3.connect(':memory:')
+    create_schema(con)
+    create_schema(con)
+
+    assert con.execute('PRAGMA user_version').fetchone()[0] == len(query.migrations)
+
+
+def test_migration_removes_duplicate_members():
+    con = sqlite3.connect(':memory:')
+    for statement in query.migrations[0]:
+        con.execute(statement)
+    con.execute(query.insert_user, ('alice', 'alice@x', 'pwd'))
+    con.execute(query.insert_channel, ('#a', 'alice', 0))
+    con.execute(query.insert_member, ('alice', '#a'))
+    con.execute(query.insert_member, ('alice', '#a'))
+    con.commit()
+
+    create_schema(con)
+    con.execute(query.insert_member, ('alice', '#a'))
+
+    assert con.execute(query.select_members, ('#a',)).fetchall() == [('alice',)]
+
+
+@pytest.mark.parametrize('statement, params', [
+    (query.select_nick, ('alice',)),
+    (query.select_nicks(3), ('alice', 'bob', 'carol')),
+    (query.select_mail, ('alice@x',)),
+    (query.select_password, ('alice',)),
+    (query.select_channel_info, ('#a',)),
+    (query.select_members, ('#a',)),
+    (query.delete_member, ('alice', '#a')),
+    (query.take_notifications, ('alice', 100)),
+    (query.update_password, ('hash', 'alice', 'pwd')),
+])
+def test_hot_queries_use_indexes(statement, params):
+    con = sqlite3.connect(':memory:')
+    create_schema(con)
+
+    plan = con.execute('EXPLAIN QUERY PLAN ' + statement, params).fetchall()
+    scans = [detail for *_, detail in plan if detail.startswith('SCAN')]
+
+    assert scans == []
+
+
+@pytest.mark.parametrize('statement', [
+    query.select_all_users,
+    query.select_all_channels,
+    query.select_all_members,
+])
+def test_bulk_loads_read_table_once(statement):
+    con = sqlite3.connect(':memory:')
+    create_schema(con)
+
+    plan = [detail for *_, detail in con.execute('EXPLAIN QUERY PLAN ' + statement)]
+
+    assert len(plan) == 1 and plan[0].startswith('SCAN')
+
+
+def test_take_notifications_pages_oldest_first():
+    con = sqlite3.connect(':memory:')
+    create_schema(con)
+    con.execute(query.insert_user, ('alice', 'alice@x', 'pwd'))
+    con.execute(query.insert_user, ('bob', 'bob@x', 'pwd'))
+    for i in range(5):
+        con.execute(query.insert_notification, ('bob', 'alice', f'hi {i}'))
+    con.execute(query.insert_notification, ('alice', 'bob', 'hello'))
+
+    first = DBService._take_notifications(con.cursor(), 'alice', 3)
+    second = DBService._take_notifications(con.cursor(), 'alice', 3)
+
+    assert first == [('bob', 'hi 0'), ('bob', 'hi 1'), ('bob', 'hi 2')]
+    assert second == [('bob', 'hi 3'), ('bob', 'hi 4')]
+    assert con.execute(select_notifications, ('bob',)).fetchall() == [('alice', 'hello')]
+
+
+def make_directory():
+    con = sqlite3.connect(':memory:')
+    create_schema(con)
+    for nick in ['alice', 'bob', 'carol']:
+        con.execute(query.insert_user, (nick, f'{nick}@x', 'pwd'))
+    con.execute(query.insert_channel, ('#pub', 'alice', 1))
+    con.execute(query.insert_channel, ('#priv', 'alice', 0))
+    con.execute(query.insert_channel, ('#bob', 'bob', 0))
+    for nick, channel in [('alice', '#priv'), ('bob', '#priv'), ('bob', '#bob'), ('carol', '#bob')]:
+        con.execute(query.insert_member, (nick, channel))
+
+    directory = Directory()
+    directory.load(con.cursor())
+    return directory
+
+
+def test_directory_loads_database():
+    directory = make_directory()
+
+    assert directory.registered(['bob', 'nobody', 'bob']) == ['bob']
+    assert directory.channels['#priv'] == ('alice', 'priv')
+    assert directory.pub_channels() == ['#pub']
+    assert sorted(directory.priv_channels('bob')) == ['#bob', '#priv']
+    assert directory.is_member('alice', '#priv')
+    assert not directory.is_member('carol', '#priv')
+
+
+def test_directory_mirrors_cascading_deletes():
+    directory = make_directory()
+
+    directory.delete_user('bob')
+
+    assert '#bob' not in directory.channels
+    assert directory.channel_members('#priv') == ['alice']
+    assert 'carol' not in directory.memberships
+    assert directory.stats() == {'users': 2, 'channels': 2, 'memberships': 1}
+
+
+class SyncPool:
+    def __init__(self, con):
+        self.con = con
+
+    def runInteraction(self, interaction, *args):
+        try:
+            result = interaction(self.con.cursor(), *args)
+            self.con.commit()
+            return defer.succeed(result)
+        except Exception:
+            self.con.rollback()
+            return defer.fail()
+
+    def connect(self):
+        return self.con
+
+
+def make_db(con):
+    db = DBService()
+    db._read_pool = db._write_pool = SyncPool(con)
+    db._writes = WriteBehind(db._write_pool, max_size=10, max_delay=60)
+    db.directory.load(con.cursor())
+    return db
+
+
+def result_of(d):
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+
+def test_write_behind_commits_batch_and_isolates_failures():
+    con = sqlite3.connect(':memory:')
+    con.execute('PRAGMA foreign_keys = ON')
+    create_schema(con)
+    con.execute(query.insert_user, ('alice', 'alice@x', 'pwd'))
+    con.commit()
+
+    writes = WriteBehind(SyncPool(con), max_size=10, max_delay=1)
+    results = []
+    for target in ['alice', 'nobody', 'alice']:
+        d = writes.write(query.insert_notification, ('alice', target, 'hi'))
+        d.addCallbacks(lambda _: results.append(True), lambda _: results.append(False))
+    writes.flush()
+
+    assert results == [True, False, True]
+    assert len(con.execute(select_notifications, ('alice',)).fetchall()) == 2
+    assert writes.stats() == {'queued': 0, 'batches': 2, 'writes': 2, 'failed': 1}
+
+
+def test_password_hash_is_salted_and_checked():
+    hashed = hash_password('secret', 4)
+
+    assert hashed != hash_password('secret', 4)
+    assert 'secret' not in hashed
+    assert check_password('secret', hashed, 4) == (True, None)
+    assert check_password('wrong', hashed, 4) == (False, None)
+
+
+def test_plaintext_and_weaker_passwords_are_rehashed():
+    correct, new_hash = check_password('secret', 'secret', 4)
+    assert correct
+    assert check_password('secret', new_hash, 4) == (True, None)
+    assert check_password('wrong', 'secret', 4) == (False, None)
+
+    correct, stronger = check_password('secret', new_hash, 5)
+    assert correct
+    assert stronger.startswith('scrypt$5$')
+
+
+def test_password_hasher_limits_work_per_key():
+    hasher = PasswordHasher(4, workers=0, max_queued=2, limits={'nick': 1})
+    results = []
+
+    for keys in [{'nick': 'alice'}, {'nick': 'alice'}, {'nick': 'bob'}, {'nick': 'carol'}]:
+        d = hasher.hash('secret', keys)
+        d.addErrback(lambda f: results.append(f.check(Overloaded)))
+
+    assert results == [Overloaded, Overloaded]
+    assert hasher.stats() == {'waiting': 2, 'running': 0, 'dropped': 1, 'rejected': 1}
+
+    hasher.stop()
+    assert results == [Overloaded] * 4
+    assert not hasher._load
+
+
+def test_queued_membership_writes_commit_before_later_transactions():
+    con = sqlite3.connect(':memory:')
+    create_schema(con)
+    for nick in ['alice', 'bob', 'carol']:
+        con.execute(query.insert_user, (nick, f'{nick}@x', 'pwd'))
+    con.execute(query.insert_channel, ('#priv', 'alice', 0))
+    for nick in ['alice', 'bob']:
+        con.execute(query.insert_member, (nick, '#priv'))
+    con.commit()
+    db = make_db(con)
+
+    # bob quits and is added back, carol is added and kicked.
+    db.delete_members('#priv', ['bob'])
+    added = result_of(db.add_members_as('alice', '#priv', ['bob']))
+    db.add_members('#priv', ['carol'])
+    kicked = result_of(db.kick_members_as('alice', '#priv', ['carol']))
+    db._writes.flush()
+
+    assert added == ('priv', 'alice', ['bob'])
+    assert kicked == ('priv', 'alice', ['carol'])
+    assert sorted(db.directory.channel_members('#priv')) == ['alice', 'bob']
+    assert sorted(r[0] for r in con.execute(query.select_members, ('#priv',))) == ['alice', 'bob']
+
+
+class LockedPool(SyncPool):
+    def __init__(self, con, locked_times):
+        super().__init__(con)
+        self.locked_times = locked_times
+
+    def runInteraction(self, interaction, *args):
+        if self.locked_times:
+            self.locked_times -= 1
+            return defer.fail(sqlite3.OperationalError('database is locked'))
+        return super().runInteraction(interaction, *args)
+
+
+@pytest.mark.parametrize('locked_times, committed', [(2, True), (4, False)])
+def test_write_behind_retries_locked_batches(locked_times, committed):
+    con = sqlite3.connect(':memory:')
+    create_schema(con)
+    con.execute(query.insert_user, ('alice', 'alice@x', 'pwd'))
+    con.commit()
+
+    clock = task.Clock()
+    writes = WriteBehind(LockedPool(con, locked_times), max_size=10, max_delay=1,
+                         lock_retries=3, clock=clock)
+    results = []
+    for content in ['hi', 'there']:
+        d = writes.write(query.insert_notification, ('alice', 'alice', content))
+        d.addCallbacks(lambda _: results.append(True), lambda _: results.append(False))
+    writes.flush()
+    clock.advance(1)
+    clock.advance(1)
+    clock.advance(1)
+
+    assert results == [committed] * 2
+    assert writes.stats()['failed'] == (0 if committed else 2)
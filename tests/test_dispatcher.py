@@ -0,0 +1,59 @@
+from chat.chat_server.dispatch import Dispatcher
+from chat.chat_server.peer import ChatClient, ChatServer
+
+
+def make_client(dispatcher):
+    return ChatClient(None, dispatcher, None, None, None)
+
+
+def test_remove_client_unsubscribes_from_its_channels_only():
+    dispatcher = Dispatcher(['#a', '#b', '#c'])
+    alice, bob = make_client(dispatcher), make_client(dispatcher)
+    dispatcher.add_peer(alice, 'alice')
+    dispatcher.add_peer(bob, 'bob')
+    dispatcher.subscribe('#a', 'alice')
+    dispatcher.subscribe('#b', 'alice')
+    dispatcher.subscribe('#b', 'bob')
+
+    dispatcher.remove_peer(alice)
+
+    assert dispatcher.is_on(['alice', 'bob']) == ['bob']
+    assert dispatcher.names('#a') == set()
+    assert dispatcher.names('#b') == {'bob'}
+    assert 'alice' not in dispatcher.user2channels
+    assert alice not in dispatcher.peer2users
+
+
+def test_remove_server_forgets_its_users():
+    dispatcher = Dispatcher()
+    server = ChatServer(None, dispatcher, None, None)
+    dispatcher.add_peer(server)
+    dispatcher.add_peer(server, 'alice')
+    dispatcher.add_peer(server, 'bob')
+
+    dispatcher.remove_peer(server)
+
+    assert dispatcher.is_on(['alice', 'bob']) == []
+    assert server not in dispatcher.server_peers
+
+
+def test_remove_channel_updates_reverse_index():
+    dispatcher = Dispatcher(['#a', '#b'])
+    dispatcher.add_peer(make_client(dispatcher), 'alice')
+    dispatcher.subscribe('#a', 'alice')
+    dispatcher.subscribe('#b', 'alice')
+
+    dispatcher.remove_channel('#a')
+
+    assert dispatcher.user2channels['alice'] == {'#b'}
+
+
+def test_relogin_moves_nick_to_new_peer():
+    dispatcher = Dispatcher()
+    old, new = make_client(dispatcher), make_client(dispatcher)
+    dispatcher.add_peer(old, 'alice')
+    dispatcher.add_peer(new, 'alice')
+
+    dispatcher.remove_peer(old)
+
+    assert dispatcher.user2peer['alice'] is new
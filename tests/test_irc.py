@@ -33,3 +33,27 @@ def test_IRCMessage_no_command():
     with pytest.raises(irc.BadMessage) as e:
         irc.Message(':prefix :bad_command param1 param2')
     assert 'No command.' in str(e)
+
+
+def test_IRCMessage_bad_command():
+    with pytest.raises(irc.BadMessage) as e:
+        irc.Message('MSG#channel :hi')
+    assert 'Bad command.' in str(e)
+
+
+def test_IRCMessage_prefix_only():
+    with pytest.raises(irc.BadMessage) as e:
+        irc.Message(':prefix')
+    assert 'No command.' in str(e)
+
+
+def test_IRCMessage_num_params():
+    with pytest.raises(irc.BadMessage) as e:
+        irc.Message('LOGIN nick1 nick2')
+    assert 'bad number of parameters' in str(e)
+
+
+def test_IRCMessage_empty_trailing():
+    msg = irc.Message('MSG #channel :')
+    assert msg.command == 'MSG'
+    assert msg.params == ['#channel']
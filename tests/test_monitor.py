@@ -0,0 +1,198 @@
+import json
+import sqlite3
+import time
+
+import pytest
+
+from monitor import app, db
+from monitor.monitor import fetch_page, get_channels, live_feed, sse_data, stats_period
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'DATABASE', str(tmp_path / 'monitor.db'))
+    with app.app_context():
+        db.init_db()
+    return app.test_client()
+
+
+def record(author='alice', channel='#general', content='hi', scores=(0.1,) * 6):
+    return {'author': author, 'channel': channel, 'content': content, 'scores': list(scores)}
+
+
+def stored_messages():
+    with app.app_context():
+        cur = db.get_db().execute('SELECT author, channel, content FROM message ORDER BY rowid')
+        return cur.fetchall()
+
+
+@pytest.mark.parametrize('body', [
+    json.dumps(record(content='a')) + '\n' + json.dumps(record(content='b')) + '\n',
+    json.dumps([record(content='a'), record(content='b')]),
+])
+def test_ingest_accepts_ndjson_and_array(client, body):
+    response = client.post('/ingest', data=body)
+
+    assert response.status_code == 204
+    assert stored_messages() == [('alice', '#general', 'a'), ('alice', '#general', 'b')]
+
+
+def test_ingest_accepts_single_object(client):
+    response = client.post('/ingest', data=json.dumps(record()))
+
+    assert response.status_code == 204
+    assert stored_messages() == [('alice', '#general', 'hi')]
+
+
+@pytest.mark.parametrize('body', [
+    json.dumps(record(content='a')) + '\n{"author": ',
+    json.dumps([record(content='a'), {'author': 'bob'}]),
+    json.dumps([record(content='a'), 'text']),
+])
+def test_ingest_rejects_malformed_records(client, body):
+    response = client.post('/ingest', data=body)
+
+    assert response.status_code == 400
+    assert stored_messages() == []
+
+
+def ingest(client, records):
+    response = client.post('/ingest', data=json.dumps(records))
+    assert response.status_code == 204
+
+
+def test_history_pages_back_with_before(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGE_SIZE', 2)
+    ingest(client, [record(content=c) for c in 'abcde'])
+
+    pages, before = [], None
+    with app.app_context():
+        while True:
+            messages, ratings, before = fetch_page(before=before)
+            pages.append([m[-1] for m in messages])
+            assert len(ratings) == len(messages)
+            if before is None:
+                break
+
+    assert pages == [['d', 'e'], ['b', 'c'], ['a']]
+
+
+def test_channel_page_only_holds_channel_messages(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGE_SIZE', 2)
+    ingest(client, [record(channel=ch, content=c) for ch, c in zip(['#a', '#b', '#a', '#a'], 'wxyz')])
+
+    with app.app_context():
+        messages, _, before = fetch_page('#a')
+        assert messages == ['alice> y', 'alice> z']
+        assert fetch_page('#a', before)[0] == ['alice> w']
+
+
+def test_history_links_older_page(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGE_SIZE', 2)
+    ingest(client, [record(content=c) for c in 'abc'])
+
+    page = client.get('/history').get_data(as_text=True)
+    assert 'alice&gt; c' in page and 'alice&gt; a' not in page
+    assert 'href="?before=2"' in page
+
+    page = client.get('/history?before=2').get_data(as_text=True)
+    assert 'alice&gt; a' in page and 'alice&gt; b' not in page
+    assert '?before=' not in page
+
+
+def test_sse_data_splits_every_line_break():
+    assert sse_data('a\r\nb\rc\nd') == 'data: a\ndata: b\ndata: c\ndata: d\n'
+
+
+def first_event(client, last_id):
+    response = client.get('/live', headers={'Last-Event-ID': str(last_id)}, buffered=False)
+    try:
+        return next(iter(response.response)).decode()
+    finally:
+        response.close()
+
+
+def test_live_streams_multiline_content_as_one_event(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'LIVE_KEEPALIVE', 0)
+    ingest(client, [record(content='one\ntwo\r\nthree')])
+
+    event = first_event(client, live_feed.last_id - 1)
+
+    assert event == (f'id: {live_feed.last_id}\n'
+                     'data: alice> one\ndata: two\ndata: three\n\n')
+
+
+def test_live_replays_buffer_for_id_from_before_restart(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'LIVE_KEEPALIVE', 0)
+    ingest(client, [record(content='a'), record(content='b')])
+    first_id = live_feed.last_id - len(live_feed.lines()) + 1
+
+    event = first_event(client, live_feed.last_id + 100)
+
+    assert event.startswith(f'id: {first_id}\n')
+
+
+def stats_rows():
+    with app.app_context():
+        cur = db.get_db().execute('SELECT channel, author, count, sum1, sum6 FROM message_stats')
+        return sorted(cur.fetchall())
+
+
+def test_ingest_adds_to_period_rollup(client, monkeypatch):
+    # Both ingests have to fall into the same period.
+    monkeypatch.setitem(app.config, 'STATS_PERIOD', 10 ** 10)
+    ingest(client, [record(scores=[0.5] * 6), record(author='bob')])
+    ingest(client, [record(scores=[0.25] * 6)])
+
+    assert stats_rows() == [('#general', 'alice', 2, 0.75, 0.75),
+                            ('#general', 'bob', 1, 0.1, 0.1)]
+
+
+def test_stats_ranks_by_mean_score(client):
+    ingest(client, [record(author='alice', scores=[0.2, 0.9, 0, 0, 0, 0]),
+                    record(author='alice', scores=[0.4, 0.9, 0, 0, 0, 0]),
+                    record(author='bob', scores=[0.5, 0.1, 0, 0, 0, 0])])
+
+    by_score1 = client.get('/stats?by=author&score=1').get_json()
+    by_score2 = client.get('/stats?by=author&score=2').get_json()
+
+    assert [row['author'] for row in by_score1] == ['bob', 'alice']
+    assert [row['author'] for row in by_score2] == ['alice', 'bob']
+    assert by_score1[1]['count'] == 2
+    assert by_score1[1]['means'][:2] == pytest.approx([0.3, 0.9])
+
+
+def test_stats_leaves_out_periods_before_since(client):
+    ingest(client, [record(channel='#new')])
+    with app.app_context():
+        conn = db.get_db()
+        with conn:
+            conn.execute('INSERT INTO message_stats VALUES(?, ?, ?, 1, 1, 1, 1, 1, 1, 1)',
+                         (stats_period(time.time() - 7200), '#old', 'alice'))
+
+    assert [row['channel'] for row in client.get('/stats?since=3600').get_json()] == ['#new']
+    assert [row['channel'] for row in client.get('/stats?since=10800').get_json()] == ['#old', '#new']
+
+
+@pytest.mark.parametrize('query', ['by=content', 'score=0', 'score=7'])
+def test_stats_rejects_bad_query(client, query):
+    assert client.get('/stats?' + query).status_code == 400
+
+
+def test_database_from_first_initdb_is_migrated(tmp_path, monkeypatch):
+    path = str(tmp_path / 'flask.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE message (author TEXT NOT NULL, channel TEXT NOT NULL, '
+                 'content TEXT NOT NULL, score1 REAL NOT NULL, score2 REAL NOT NULL, '
+                 'score3 REAL NOT NULL, score4 REAL NOT NULL, score5 REAL NOT NULL, '
+                 'score6 REAL NOT NULL)')
+    conn.execute("INSERT INTO message VALUES ('alice', '#general', 'hi', 0, 0, 0, 0, 0, 0)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setitem(app.config, 'DATABASE', path)
+
+    client = app.test_client()
+    assert client.get('/stats').get_json() == []
+    with app.app_context():
+        assert get_channels() == ['general']
+        assert db.schema_version(db.get_db()) == len(db.migrations)